@@ -0,0 +1,85 @@
+"""
+REST server load test.
+
+Serves a small json route and a 500 episode list with each server backend
+and hammers them from client threads, over persistent connections and
+with a new connection per request.
+
+    python -m benchmarks.bench_restserver [clients] [requests per client]
+"""
+import http.client
+import sys
+import threading
+import time
+
+from rssdldmng.rssdld.episode import Episode
+from rssdldmng.utils.restserver import RESTHttpServer, RESTRequestHandler
+
+
+def make_episodes(n):
+    episodes = []
+    for i in range(n):
+        ep = Episode()
+        ep.title = 'Show {0} S01E{1:02d} 720p'.format(i // 20, i % 20)
+        ep.showname = 'Show {0}'.format(i // 20)
+        ep.season = 1
+        ep.episode = i % 20
+        ep.hash = '{0:040X}'.format(i)
+        episodes.append(ep)
+    return episodes
+
+
+EPISODES = make_episodes(500)
+ROUTES = {
+    r'^/api/status$': {'GET': lambda h: {'new': 1, 'downloading': 2, 'available': 3}, 'media_type': 'application/json'},
+    r'^/api/latest$': {'GET': lambda h: EPISODES, 'media_type': 'application/json'},
+}
+
+
+def client(port, path, count, keep_alive, errors):
+    conn = None
+    for _ in range(count):
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+            rsp = conn.getresponse()
+            rsp.read()
+            if rsp.status != 200:
+                errors.append(rsp.status)
+            if not keep_alive:
+                conn.close()
+                conn = None
+        except Exception as e:
+            errors.append(e)
+            conn = None
+
+
+def run(backend, path, clients, count, keep_alive):
+    srv = RESTHttpServer('127.0.0.1', 0, ROUTES, backend=backend)
+    srv.start()
+    errors = []
+    threads = [threading.Thread(target=client, args=(srv.server.server_address[1], path, count, keep_alive, errors))
+               for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    srv.stop()
+    print('{:<10s} {:<12s} {:<11s} {:8d} requests {:10.1f} req/s {:4d} errors'.format(
+        backend, path, 'keep-alive' if keep_alive else 'close', clients * count, clients * count / elapsed, len(errors)))
+
+
+def main(clients=16, count=200):
+    # the threaded handler logs every request to stderr, measure the server not the terminal
+    RESTRequestHandler.log_message = lambda *args: None
+    for path in ('/api/status', '/api/latest'):
+        for keep_alive in (True, False):
+            for backend in ('threading', 'asyncio'):
+                run(backend, path, clients, count, keep_alive)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,123 @@
+"""
+ShowsDB micro-benchmark.
+
+Compares the per-operation cost of opening a fresh pysqlw connection for
+every call (the old DBO behaviour) against the pooled per-thread connection,
+per-item feed ingest against the single transaction addEpisodes(), and
+loading the whole history through dict rows against tuple rows.
+
+    python -m benchmarks.bench_showsdb [rows]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from rssdldmng.pysqlw import pysqlw
+from rssdldmng.rssdld.episode import Episode, IState
+from rssdldmng.rssdld.showsdb import ShowsDB
+
+
+def make_episode(i):
+    ep = Episode()
+    ep.title = 'Show {0} S01E{1:02d} 720p'.format(i % 500, i % 100)
+    ep.published = 1500000000 + i
+    ep.link = 'magnet:?xt=urn:btih:{0:040x}'.format(i)
+    ep.uid = i
+    ep.showid = i % 500
+    ep.showname = 'Show {0}'.format(i % 500)
+    ep.hash = '{0:040x}'.format(i)
+    ep.quality = '720p'
+    ep.season = 1
+    ep.episode = i % 100
+    ep.dir = '/tmp/Show {0}/Season01/'.format(i % 500)
+    ep.state = IState.WATCHED.value
+    return ep
+
+
+def populate(db_path, rows):
+    db = ShowsDB(db_path)
+    db.open()
+    conn = db.connection().wrapper.dbc
+    eps = [make_episode(i).as_dict() for i in range(rows)]
+    keys = list(eps[0].keys())
+    conn.executemany('INSERT INTO episodes ({0}) VALUES ({1})'.format(
+        ', '.join(keys), ', '.join('?' * len(keys))), [tuple(e[k] for k in keys) for e in eps])
+    conn.commit()
+    db.close()
+
+
+def timeit(name, ops, func):
+    start = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print('{:<40s} {:8d} ops {:10.2f} us/op'.format(name, ops, elapsed * 1e6 / ops))
+
+
+def main(rows=50000, ops=2000):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'shows.db')
+        populate(db_path, rows)
+        print('episodes table: {0} rows'.format(rows))
+
+        def old_get(i):
+            db = pysqlw(db_type='sqlite', db_path=db_path)
+            db.where('hash', '{0:040x}'.format(i * 7 % rows)).get('episodes')
+            db.close()
+
+        def old_update(i):
+            db = pysqlw(db_type='sqlite', db_path=db_path)
+            db.where('hash', '{0:040x}'.format(i * 7 % rows)).update('episodes', {'state': IState.WATCHED.value})
+            db.close()
+
+        sdb = ShowsDB(db_path)
+        sdb.open()
+        eps = [make_episode(i * 7 % rows) for i in range(ops)]
+
+        timeit('getEpisode (connect per call)', ops, old_get)
+        timeit('getEpisode (pooled)', ops, lambda i: sdb.getEpisode(eps[i].hash))
+        timeit('updateEpisodeState (connect per call)', ops, old_update)
+        timeit('updateEpisodeState (pooled)', ops, lambda i: sdb.updateEpisodeState(eps[i], IState.WATCHED.value))
+
+        feed = [make_episode(rows + i) for i in range(5000)]
+
+        def old_ingest(ep):
+            db = pysqlw(db_type='sqlite', db_path=db_path)
+            if not db.where('hash', ep.hash).get('episodes'):
+                if not db.where('hash', ep.hash).get('episodes'):
+                    db.insert('episodes', ep.as_dict())
+            db.close()
+
+        start = time.perf_counter()
+        for ep in feed:
+            old_ingest(ep)
+        print('{:<40s} {:8d} items {:10.2f} ms'.format('ingest (per item)', len(feed), (time.perf_counter() - start) * 1e3))
+
+        feed = [make_episode(rows + len(feed) + i) for i in range(5000)]
+        start = time.perf_counter()
+        sdb.addEpisodes(feed)
+        print('{:<40s} {:8d} items {:10.2f} ms'.format('ingest (addEpisodes)', len(feed), (time.perf_counter() - start) * 1e3))
+        start = time.perf_counter()
+        sdb.addEpisodes(feed)
+        print('{:<40s} {:8d} items {:10.2f} ms'.format('re-ingest (addEpisodes)', len(feed), (time.perf_counter() - start) * 1e3))
+
+        def load(name, func):
+            start = time.perf_counter()
+            eps = func()
+            elapsed = time.perf_counter() - start
+            del eps
+            tracemalloc.start()
+            eps = func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:<40s} {:8d} rows  {:10.2f} ms {:8.1f} MB peak'.format(name, len(eps), elapsed * 1e3, peak / 1e6))
+
+        load('load all (dict rows)', lambda: [Episode(entries=row) for row in sdb.connection().get('episodes')])
+        load('load all (tuple rows)', lambda: sdb.getEpisodes())
+        sdb.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,61 @@
+"""
+Release title parser micro-benchmark.
+
+Parses a 10k item feed built from tests/data/titles.txt with the legacy
+per-call regex helpers and with titleparser.parse (uncached).
+
+    python -m benchmarks.bench_titleparser [items]
+"""
+import os
+import re
+import sys
+import time
+
+from rssdldmng.rssdld.titleparser import parse
+
+CORPUS = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data', 'titles.txt')
+
+
+def legacy_quality(title):
+    if '480p' in title:
+        return '480p'
+    elif '720p' in title:
+        return '720p'
+    elif '1080p' in title:
+        return '1080p'
+    else:
+        return 'na'
+
+
+def legacy_numbering(title):
+    try:
+        m = re.search('.*S([0-9]{2})E([0-9]{2}).*', title, re.IGNORECASE)
+        return [int(m.group(1)), int(m.group(2))]
+    except Exception:
+        try:
+            m = re.search('.*([0-9]{1,2})x([0-9]{2}).*', title, re.IGNORECASE)
+            return [int(m.group(1)), int(m.group(2))]
+        except Exception:
+            return [0, 0]
+
+
+def legacy_parse(title):
+    # what Episode.__init__ used to do for every feed item
+    return (legacy_quality(title), legacy_numbering(title)[1], legacy_numbering(title)[0])
+
+
+def main(items=10000):
+    with open(CORPUS) as f:
+        corpus = [line.split('|')[0].strip() for line in f if line.strip() and not line.startswith('#')]
+    titles = ['{0} {1}'.format(corpus[i % len(corpus)], i) for i in range(items)]
+
+    for name, func in (('legacy', legacy_parse), ('titleparser', parse.__wrapped__)):
+        start = time.perf_counter()
+        for t in titles:
+            func(t)
+        elapsed = time.perf_counter() - start
+        print('{:<16s} {:8d} titles {:10.2f} ms {:8.2f} us/title'.format(name, items, elapsed * 1e3, elapsed * 1e6 / items))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
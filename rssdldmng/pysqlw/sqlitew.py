@@ -14,7 +14,8 @@ class sqlitew(sqltype):
         try:
             log.info('connecting to %s', self.args.get('db_path'))
             import sqlite3
-            self.dbc = sqlite3.connect(self.args.get('db_path'))
+            self.dbc = sqlite3.connect(self.args.get('db_path'),
+                                       check_same_thread=self.args.get('check_same_thread', True))
             self.dbc.row_factory = self._sqlite_dict_factory
             # self.dbc.set_trace_callback(print)
             self.cursor = self.dbc.cursor()
@@ -1,14 +1,19 @@
-import time
-import re
+import hashlib
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import feedparser
+import requests
 
 from ..utils.sthread import ServiceThread
+from ..utils.scheduler import Scheduler
 
 from .showsdb import ShowsDB
+from .statemachine import StateMachine, MANUAL
 from .kodidb import KodiDB
 from .episode import Episode, IState
+from .series import SeriesIndex
 from .transmission import Transmission
 from .trakt import Trakt
 
@@ -26,42 +31,70 @@ class Downloader(ServiceThread):
         self.config = config
 
         self.feeds = self.config['feeds']
+        self.feed_workers = self.config.get('feed_workers', 8)
+        self.feed_timeout = tuple(self.config.get('feed_timeout', [10, 30]))  # connect, read
         self.fconfig = self.config['filters']
         self.tconfig = self.config['transmission']
         self.kconfig = self.config.get('kodi', None)
         self.tkconfig = self.config.get('trakt', None)
 
-        self.last_feed_poll = 0
-        self.last_poll = 0
+        self.scheduler = None
 
         self.db = None
+        self.sm = None
         self.tc = None
         self.kd = None
         self.tk = None
 
         self.series = None
+        self.series_index = None
+        self.filters = None
+        self.filters_ready = False
+        self.feedstats = {}
+        # enriched episodes of the last latest_days, rebuilt every progress cycle
+        self.latest_days = self.config.get('latest_days', 21)
+        self.latest = ()
 
         ServiceThread.__init__(self)
 
     def serve_starting(self):
         # connect to DB
         self.db = ShowsDB(self.db_file)
+        self.db.open()
+        self.sm = StateMachine(self.db, self.config.get('check_intervals'))
+        self.sm.handle(IState.NEW, self.checkNew)
+        self.sm.handle(IState.DOWNLOADING, self.checkDownloading)
+        self.sm.handle(IState.FINISHED, self.checkFinished)
+        self.sm.handle(IState.UPDATING, self.checkUpdating)
+        self.sm.handle(IState.AVAILABLE, self.checkAvailable)
         self.connectTrakt()
-        log.info('Started downloader')
+        # feeds are never checked without filters
+        self.updateFilters()
 
-    def serve(self):
-        # main loop
         ifeedpoll = self.config['feed_poll_interval']
-        ipoll = self.config['poll_interval']
+        ifilters = self.config.get('filters_refresh_interval', ifeedpoll)
+        imaintenance = self.config.get('maintenance_interval', 86400)
+
+        self.scheduler = Scheduler(notify=self.wakeup)
+        self.scheduler.add('feeds', self.checkFeeds, ifeedpoll)
+        self.scheduler.add('progress', self.checkProgress, self.config['poll_interval'])
+        self.scheduler.add('filters', self.updateFilters, ifilters, delay=ifilters)
+        self.scheduler.add('maintenance', self.db.maintenance, imaintenance, delay=imaintenance)
+        if self.tk and self.traktList() is not None:
+            # cheap while the cached list is fresh
+            self.scheduler.add('trakt', self.refreshTrakt, min(300, self.tkconfig.get('list_ttl', 3600)))
+        if self.tk and self.tk.report_progress:
+            self.scheduler.add('trakt_sync', self.flushTrakt, self.tkconfig.get('sync_interval', 300))
+        log.info('Started downloader')
 
-        if ifeedpoll > 0 and time.time() - self.last_feed_poll >= ifeedpoll:
-            self.last_feed_poll = time.time()
-            self.updateFilters()
-            self.checkFeeds()
+    def serve(self):
+        # main loop: sleep until the next job is due or a job is woken up
+        delay = self.scheduler.run_pending()
+        return delay if delay is not None else 3600
 
-        if ipoll > 0 and time.time() - self.last_poll >= ipoll:
-            self.last_poll = time.time()
-            self.checkProgress()
+    def wake(self, job):
+        # run a job now, e.g. on API request
+        return self.scheduler is not None and self.scheduler.wake(job)
 
     def serve_stop(self):
         log.debug('Stopping downloader')
@@ -69,6 +102,14 @@ class Downloader(ServiceThread):
             self.tk.cancel_authentication()
 
     def serve_stopped(self):
+        if self.scheduler:
+            self.scheduler.shutdown()
+        if self.db:
+            self.db.close()
+        if self.tc:
+            self.tc.close()
+        if self.kd:
+            self.kd.stopListening()
         log.info('Stopped downloader')
 
     def connectTrakt(self):
@@ -99,48 +140,107 @@ class Downloader(ServiceThread):
         if self.kconfig is not None and self.kd is None:
             try:
                 log.debug('connect to kodi')
-                self.kd = KodiDB(self.kconfig)
+                # episode dirs are all below the static part of the dir template
+                self.kd = KodiDB(self.kconfig, self.config['dir'].split('{')[0])
+                if self.kconfig.get('listen', True):
+                    # library changes wake the progress job, polling kodi becomes the fallback
+                    self.kd.listen(lambda: self.wake('progress'))
             except Exception as e:
                 log.error('FAILED to connect to kodi: exception [{0}]'.format(e))
                 self.kd = None
                 return False
         return True
 
+    def traktList(self):
+        # name of the trakt list used as series filter, None if filter does not come from trakt
+        series = self.fconfig.get('series', None)
+        if isinstance(series, str) and series.startswith('trakt:'):
+            return series.split(':')[1]
+        return None
+
+    def refreshTrakt(self):
+        # runs on its own schedule, feed checks only ever read the cached list
+        tklist = self.traktList()
+        if self.tk and tklist is not None and self.tk.refreshTvShows(tklist):
+            log.debug('Trakt list {0} changed'.format(tklist))
+            self.wake('filters')
+
+    def queueTrakt(self, action, ep):
+        # trakt is updated in batches by the trakt_sync job, the outbox survives restarts
+        if self.tk and self.tk.report_progress:
+            self.db.queueTraktUpdate(action, ep.showname, ep.season, ep.episode)
+
+    def flushTrakt(self, batch=100):
+        if not self.tk or not self.tk.is_authenticated():
+            return
+        while True:
+            updates = self.db.getTraktUpdates(batch)
+            if not updates:
+                return
+            for action in ('collected', 'watched'):
+                ids = [u['id'] for u in updates if u['action'] == action]
+                if not ids:
+                    continue
+                try:
+                    # reported with the time they were queued, retries may come hours later
+                    self.tk.syncEpisodes(action, [(u['showname'], u['season'], u['episode'], u['queued'])
+                                                  for u in updates if u['action'] == action])
+                    self.db.deleteTraktUpdates(ids)
+                except Exception as e:
+                    log.warn('cannot report {0} {1} episodes to trakt [{2}]'.format(len(ids), action, e))
+                    dropped = self.db.deferTraktUpdates(ids, self.tkconfig.get('retry_backoff', 60), 6 * 3600,
+                                                        self.tkconfig.get('max_attempts', 40))
+                    if dropped:
+                        log.error('dropped {0} {1} trakt updates after too many failures'.format(dropped, action))
+                    return
+
     def updateFilters(self):
         series = []
+        # feeds run in parallel with this job: readiness is only published
+        # once the series index is in place
+        ready = True
         if 'series' in self.fconfig :
             if isinstance(self.fconfig['series'], list):
                 log.debug('get series from config file')
                 series.extend(self.fconfig['series'])
             elif isinstance(self.fconfig['series'], str):
-                if self.fconfig['series'].startswith('trakt:'):
-                    tklist = self.fconfig['series'].split(':')[1]
-                    if self.tk:
-                        log.debug('get series from Trakt')
-                        # TODO: this should be done async ...
-                        series.extend(self.tk.getTvShows(tklist))
+                tklist = self.traktList()
+                if tklist is not None:
+                    shows = self.tk.getCachedTvShows(tklist) if self.tk else None
+                    if shows is not None:
+                        log.debug('get series from Trakt cache')
+                        series.extend(shows)
                     else:
-                        log.warn('not connected to Trakt: could not get series list')
+                        log.warn('Trakt list {0} not available yet: could not get series list'.format(tklist))
+                        ready = False
                 else:
                     log.debug('unsupported series filter string format')
             else:
                 log.debug('unsupported series filter format')
 
-        series = [re.sub('[\\/:"*?<>|]+', '', x).lower() for x in series]
-        series = list(set(series))
+        aliases = self.fconfig.get('aliases', {})
+        index = SeriesIndex(series, aliases, self.db.getShowIds())
 
-        if len(series):
-            log.debug('Series updated [{0}]: \n{1}'.format(len(series), str.join(', ', series)))
-            self.series = series
+        if len(index):
+            log.debug('Series updated [{0}]: \n{1}'.format(len(index), str.join(', ', index.names)))
+            self.series = index.names
+            self.series_index = index
         else:
             log.debug('No series filter will be applied')
 
+        # feeds are parsed again, even if unchanged, once filters change
+        self.filters = hashlib.sha1(repr((self.series, sorted(aliases.items()), self.fconfig.get('quality')))
+                                    .encode('utf-8')).hexdigest()
+        was_ready, self.filters_ready = self.filters_ready, ready
+        if ready and not was_ready:
+            self.wake('feeds')
+
     def checkFilter(self, ep):
         # filter out specials ???
         # if ep.season <= 0 or ep.episode <= 0:
         #    return False
-        if self.series is not None:
-            if ep.showname.lower() not in self.series:
+        if self.series_index is not None:
+            if not self.series_index.match(ep):
                 return False
         # if 'series' in self.fconfig and self.fconfig['series']:
         #     if ep.showname.lower() not in self.fconfig['series']:
@@ -150,6 +250,32 @@ class Downloader(ServiceThread):
                 return False
         return True
 
+    def fetchFeed(self, feed, state):
+        # returns (content, new fetch state), content is None if the feed did not change since last fetch
+        if not feed.startswith(('http://', 'https://')):
+            return (feed, {})
+        headers = {}
+        if state.get('filters') == self.filters:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('modified'):
+                headers['If-Modified-Since'] = state['modified']
+        rsp = requests.get(feed, headers=headers, timeout=self.feed_timeout)
+        if rsp.status_code == 304:
+            log.debug('feed not modified (%s)', state.get('etag') or state.get('modified'))
+            return (None, state)
+        rsp.raise_for_status()
+        newstate = {
+            'etag': rsp.headers.get('ETag', None),
+            'modified': rsp.headers.get('Last-Modified', None),
+            'digest': hashlib.sha1(rsp.content).hexdigest(),
+            'filters': self.filters,
+        }
+        if newstate['digest'] == state.get('digest') and state.get('filters') == self.filters:
+            log.debug('feed content unchanged (%s)', newstate['digest'])
+            return (None, newstate)
+        return (rsp.content, newstate)
+
     def getFeedEpisodes(self, feed):
         pfeed = feedparser.parse(feed)
         items = []
@@ -157,154 +283,257 @@ class Downloader(ServiceThread):
             items.append(Episode(item))
         return items
 
+    def downloadFeed(self, feed, state):
+        # runs in a fetch worker: download and parse only, filtering and db access stay in the caller
+        try:
+            content, state = self.fetchFeed(feed, state)
+            if content is None:
+                return (state, None, None)
+            return (state, self.getFeedEpisodes(content), None)
+        except Exception as e:
+            return (state, None, e)
+
     def checkFeeds(self):
         log.debug("-------------------------------------------------------------------------------")
-        for feed in self.feeds:
-            self.parseFeed(feed)
+        if not self.feeds:
+            return
+        if not self.filters_ready:
+            log.info('series filter not available yet, feeds not checked')
+            return
+        states = {feed: self.db.getFeedState(feed) for feed in self.feeds}
+        with ThreadPoolExecutor(max_workers=max(1, min(len(self.feeds), self.feed_workers))) as pool:
+            futures = {pool.submit(self.downloadFeed, feed, states[feed]): feed for feed in self.feeds}
+            for future in as_completed(futures):
+                self.ingestFeed(futures[future], *future.result())
 
     def parseFeed(self, feed):
+        return self.ingestFeed(feed, *self.downloadFeed(feed, self.db.getFeedState(feed)))
+
+    def ingestFeed(self, feed, state, episodes, error):
         log.info("check rss feed {0}".format(feed))
 
+        stats = self.feedstats.setdefault(feed, [0, 0])
+        stats[0] += 1
+        if error is not None:
+            strresult = "cannot fetch feed: {0}".format(error)
+            log.error(strresult)
+            return strresult
+        if episodes is None:
+            self.db.setFeedState(feed, state)
+            stats[1] += 1
+            strresult = "feed unchanged, skipped {0} of {1} polls".format(stats[1], stats[0])
+            log.info(strresult)
+            return strresult
+
         total = 0
-        added = 0
         skipped = 0
+        accepted = []
 
-        for ep in self.getFeedEpisodes(feed):
+        for ep in episodes:
             total += 1
             if not self.checkFilter(ep):
                 log.debug('skipped f : %s', ep)
                 skipped += 1
                 continue
-            dbep = self.db.getEpisode(ep.hash)
-            if not dbep:
-                ep.state = IState.NEW.value
-                ep.set_dir(self.config['dir'])
-                # TODO: ep.date = now()
-                dbep = self.db.addEpisode(ep)
-                log.debug('add to db : %s', dbep)
-                added += 1
-            else:
-                log.debug('existing  : %s', dbep)
-
-        strresult = "found {0} items: {1} accepted, {2} rejected".format(total, added, skipped)
+            ep.state = IState.NEW.value
+            ep.set_dir(self.config['dir'])
+            # TODO: ep.date = now()
+            accepted.append(ep)
+
+        added = self.db.addEpisodes(accepted)
+        # stored only once the items are in: a failed ingest is retried with the next poll
+        # instead of the feed being skipped as unchanged
+        self.db.setFeedState(feed, state)
+        for ep in added:
+            log.debug('add to db : %s', ep)
+        log.debug('existing  : %d items', len(accepted) - len(added))
+        added = len(added)
+        if added:
+            # start downloads and show them in latest without waiting for the poll
+            self.wake('progress')
+
+        strresult = "found {0} items: {1} accepted, {2} rejected, skipped {3} of {4} polls".format(
+            total, added, skipped, stats[1], stats[0])
         log.info(strresult)
         return strresult
 
     def checkProgress(self):
         log.debug("-------------------------------------------------------------------------------")
         log.info("checking progress ...")
+        torrents = None
+        try:
+            torrents = self.updateProgress()
+        finally:
+            self.refreshLatest(torrents)
+            self.dumpStats()
+
+    def updateProgress(self):
+        # move episodes through the download states, returns the torrents snapshot used
 
         self.connectTransmission()
         self.connectKodi()
+        if self.kd is not None:
+            self.kd.refresh()
 
         if self.tc is None:
-            self.dumpStats()
+            return None
+
+        # one torrent-get for the whole cycle
+        torrents = self.tc.snapshot()
+        if torrents is None:
+            log.error('could not get torrents from transmission')
+            return None
+
+        # torrent mutations are sent batched at the end of the cycle
+        commands = self.tc.commands(torrents)
+        try:
+            self.advanceEpisodes(torrents, commands)
+        finally:
+            commands.flush()
+            if self.kd is not None:
+                # start the scans requested in this cycle
+                self.kd.tickScans()
+        return torrents
+
+    def advanceEpisodes(self, torrents, commands):
+        # only episodes that are due, or that torrent / library activity touched, are checked
+        if torrents.full:
+            # also catches torrents removed behind our back
+            self.sm.markStatesDue([IState.DOWNLOADING])
+        else:
+            self.sm.markDue(torrents.changed)
+        if self.kd is not None:
+            self.libraryChanged(self.kd.takeUpdated())
+        checked = self.sm.run(torrents, commands)
+        log.debug('checked %d due episodes', checked)
+
+    def libraryChanged(self, updated):
+        # make the episodes of changed library entries due, all library dependent ones if unknown
+        if updated is None:
+            self.sm.markStatesDue([IState.NEW, IState.FINISHED, IState.UPDATING, IState.AVAILABLE])
             return
-
-        # add new items in transmission
-        log.debug("adding new items to transmission")
-        for ep in self.db.getEpisodes(IState.NEW.value):
-            # if item already in kodi, skip it
-            if self.kd and self.kd.getVideo(ep.showname, ep.season, ep.episode):
-                log.debug('in library: %s', ep)
-                self.db.updateEpisodeState(ep, IState.AVAILABLE.value)
-                continue
-            # download item if not already downloading
-            tcitem = self.tc.get(ep.hash)
-            if not tcitem:
-                self.tc.add(ep.link, ep.dir)
-                log.debug('add to tr : %s', ep)
-            else:
-                log.debug('existing  : %s', ep)
-            self.db.updateEpisodeState(ep, IState.DOWNLOADING.value)
-
-        # add finished items in kodi
-        log.debug("check items finished downloading")
-        for ep in self.db.getEpisodes(IState.DOWNLOADING.value):
-            tcitem = self.tc.get(ep.hash)
-            if tcitem:
-                # log.debug('tc: %s', tcitem)
-                if tcitem.progress != 100.0:
-                    log.debug('downloadin: %s', ep)
-                    self.tc.start(ep.hash)  # might be paused
-                else:
-                    log.debug('finished  : %s', ep)
-                    self.tc.stop(ep.hash)
-                    self.db.updateEpisodeState(ep, IState.FINISHED.value)
+        hashes = []
+        for show, season, episode in updated:
+            for state in (IState.NEW, IState.UPDATING, IState.AVAILABLE):
+                for ep in self.db.iterEpisodes(state.value, season=season, episode=episode):
+                    if show.startswith(ep.showname.lower()):
+                        hashes.append(ep.hash)
+        self.sm.markDue(hashes)
+
+    def checkNew(self, ep, torrents, commands):
+        # if item already in kodi, skip it
+        if self.kd and self.kd.getVideo(ep.showname, ep.season, ep.episode):
+            log.debug('in library: %s', ep)
+            self.sm.transition(ep, IState.AVAILABLE.value)
+            return
+        # download item if not already downloading
+        tcitem = torrents.get(ep.hash)
+        if not tcitem:
+            # stays NEW, and is retried next cycle, if transmission refuses it
+            commands.add(ep.link, ep.dir, ep.hash,
+                         lambda ok, ep=ep: ok and self.sm.transition(ep, IState.DOWNLOADING.value))
+            log.debug('add to tr : %s', ep)
+        else:
+            log.debug('existing  : %s', ep)
+            self.sm.transition(ep, IState.DOWNLOADING.value)
+
+    def checkDownloading(self, ep, torrents, commands):
+        tcitem = torrents.get(ep.hash)
+        if tcitem:
+            if tcitem.progress != 100.0:
+                log.debug('downloadin: %s', ep)
+                commands.start(ep.hash)  # might be paused
             else:
-                self.tc.add(ep.link, ep.dir)
-                log.debug('add to tr : %s', ep)
-
-        log.debug("remove finished items from transmission")
-        for ep in self.db.getEpisodes(IState.FINISHED.value):
-            # remove from transmission
-            tcitem = self.tc.get(ep.hash)
-            if tcitem:
-                log.debug('remove tr : %s', ep)
-                self.tc.remove(ep.hash)
-            if self.kd is not None:
-                # add to kodi
-                self.kd.updateLibPath(ep.dir)
-                # update state to UPDATING
-                self.db.updateEpisodeState(ep, IState.UPDATING.value)
-
+                log.debug('finished  : %s', ep)
+                commands.stop(ep.hash)
+                self.sm.transition(ep, IState.FINISHED.value)
+        else:
+            commands.add(ep.link, ep.dir, ep.hash)
+            log.debug('add to tr : %s', ep)
+
+    def checkFinished(self, ep, torrents, commands):
+        # remove from transmission
+        if ep.hash in torrents:
+            log.debug('remove tr : %s', ep)
+            commands.remove(ep.hash)
+        if self.kd is not None:
+            # add to kodi
+            self.kd.updateLibPath(ep.dir)
+            self.sm.transition(ep, IState.UPDATING.value)
+
+    def checkUpdating(self, ep, torrents, commands):
         if self.kd is None:
-            self.dumpStats()
             return
+        ke = self.kd.getVideo(ep.showname, ep.season, ep.episode)
+        if ke and ke.file:
+            log.debug('in library: %s', ep)
+            self.sm.transition(ep, IState.AVAILABLE.value)
+            # remove from transmission
+            commands.remove(ep.hash)
+            # set collected in trakt
+            self.queueTrakt('collected', ep)
+        else:
+            log.debug('not found : %s', ep)
+            # no-op while its scan is pending, running or recent
+            self.kd.updateLibPath(ep.dir)
 
-        # mark items found in kodi as available
-        log.debug("add items to kodi")
-        for ep in self.db.getEpisodes(IState.UPDATING.value):
-            ke = self.kd.getVideo(ep.showname, ep.season, ep.episode)
-            if ke and ke.file:
-                log.debug('in library: %s', ep)
-                # update state to AVAILABLE
-                self.db.updateEpisodeState(ep, IState.AVAILABLE.value)
-                # remove from transmission
-                self.tc.remove(ep.hash)
-                # set collected in trakt
-                if self.tk:
-                    self.tk.setCollected(ep.showname, ep.season, ep.episode)
-            else:
-                log.debug('not found : %s', ep)
-                # trigger another lib update
-                self.kd.updateLibPath(ep.dir)
-
+    def checkAvailable(self, ep, torrents, commands):
         # ckeck if available items were watched
-        log.debug("mark watched items")
-        for ep in self.db.getEpisodes(IState.AVAILABLE.value):
-            ke = self.kd.getVideo(ep.showname, ep.season, ep.episode)
-            if ke and ke.playcount >= 1:
-                log.debug('watched   : %s', ep)
-                # update state to WATCHED
-                self.db.updateEpisodeState(ep, IState.WATCHED.value)
-                # update watched state in trakt
-                if self.tk:
-                    self.tk.setWatched(ep.showname, ep.season, ep.episode)
-
-        self.dumpStats()
+        if self.kd is None:
+            return
+        ke = self.kd.getVideo(ep.showname, ep.season, ep.episode)
+        if ke and ke.playcount >= 1:
+            log.debug('watched   : %s', ep)
+            self.sm.transition(ep, IState.WATCHED.value)
+            # update watched state in trakt
+            self.queueTrakt('watched', ep)
+
+    def refreshLatest(self, torrents):
+        # rebuild the enriched episodes served by getLatest; readers keep using
+        # the previous tuple until it is swapped, entries are never modified
+        published = int(time.time()) - 86400 * self.latest_days
+        latest = []
+        for ep in self.db.getEpisodes(published=published):
+            ep.torrent = torrents.get(ep.hash) if torrents is not None else {}
+            ep.library = self.kd.getVideo(ep.showname, ep.season, ep.episode) if self.kd else {}
+            latest.append(ep)
+        self.latest = tuple(latest)
 
     def dumpStats(self):
         # print stats
+        stats = self.db.getStats()
         log.info("new {}, downloading {}, finished {}, updating {}, available {}, watched {}, invalid {}".format(
-                len(self.db.getEpisodes(IState.NEW.value)),
-                len(self.db.getEpisodes(IState.DOWNLOADING.value)),
-                len(self.db.getEpisodes(IState.FINISHED.value)),
-                len(self.db.getEpisodes(IState.UPDATING.value)),
-                len(self.db.getEpisodes(IState.AVAILABLE.value)),
-                len(self.db.getEpisodes(IState.WATCHED.value)),
-                len(self.db.getEpisodes(IState.NONE.value))
+                stats.get(IState.NEW.value, 0),
+                stats.get(IState.DOWNLOADING.value, 0),
+                stats.get(IState.FINISHED.value, 0),
+                stats.get(IState.UPDATING.value, 0),
+                stats.get(IState.AVAILABLE.value, 0),
+                stats.get(IState.WATCHED.value, 0),
+                stats.get(IState.NONE.value, 0)
             ))
 
+    def getStats(self):
+        return self.db.getStats()
+
+    def getRpcStats(self):
+        return {'transmission': self.tc.stats() if self.tc else {}}
+
     # extern API
 
+    def getLatest(self, days):
+        # served from the last progress cycle, no transmission/kodi calls
+        published = int(time.time()) - 86400 * days
+        return [ep for ep in self.latest if ep.published >= published]
+
     def getEpisodesFull(self, state=-1, published=-1):
         lst = []
+        # as of the last progress cycle, polling here would eat its recently-active delta
+        torrents = self.tc.lastSnapshot() if self.tc else None
         for ep in self.db.getEpisodes(state, published):
             tr = {}
             ke = {}
-            if self.tc:
-                tr = self.tc.get(ep.hash)
+            if torrents is not None:
+                tr = torrents.get(ep.hash)
             if self.kd:
                 ke = self.kd.getVideo(ep.showname, ep.season, ep.episode)
             ep.torrent = tr
@@ -317,15 +546,22 @@ class Downloader(ServiceThread):
     def getEpisodes(self, state=-1, published=-1):
         return self.db.getEpisodes(state, published)
 
+    def iterEpisodes(self, state=-1, published=-1, showname=None, season=-1, episode=-1):
+        return self.db.iterEpisodes(state, published, showname, season, episode)
+
+    def getEpisodePage(self, limit, after=None, fields=None, **filters):
+        return self.db.getEpisodePage(limit, after, fields, **filters)
+
     # manual state update
     def updateEpisode(self, ephash, state):
         dbep = self.db.getEpisode(ephash)
-        if dbep:
-            self.db.updateEpisodeState(dbep, state)
+        if dbep and state in set(s.value for s in IState):
+            self.sm.transition(dbep, state, MANUAL)
             if state is IState.AVAILABLE.value and self.tc is not None:
                 self.tc.remove(ephash)
-            if state is IState.WATCHED.value and self.tk is not None:
-                self.tk.setWatched(dbep.showname, dbep.season, dbep.episode)
+            if state is IState.WATCHED.value:
+                self.queueTrakt('watched', dbep)
+            self.wake('progress')
             return True
         return False
 
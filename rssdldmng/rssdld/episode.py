@@ -1,8 +1,9 @@
 import logging
-import re
 from enum import Enum
 from time import mktime
 
+from .titleparser import parse, normalize_name
+
 log = logging.getLogger(__name__)
 
 
@@ -17,29 +18,24 @@ class IState(Enum):
 
 
 def getQuality(title):
-    if '480p' in title:
-        return '480p'
-    elif '720p' in title:
-        return '720p'
-    elif '1080p' in title:
-        return '1080p'
-    else:
-        return 'na'
+    return parse(title).quality
 
 
 def getNumbering(title):
-    try:
-        m = re.search('.*S([0-9]{2})E([0-9]{2}).*', title, re.IGNORECASE)
-        return [int(m.group(1)), int(m.group(2))]
-    except Exception:
-        try:
-            m = re.search('.*([0-9]{1,2})x([0-9]{2}).*', title, re.IGNORECASE)
-            return [int(m.group(1)), int(m.group(2))]
-        except Exception:
-            return [0, 0]
+    t = parse(title)
+    return [t.season, t.episode]
+
+
+# db columns, in table order
+FIELDS = ('title', 'published', 'link', 'uid', 'showid', 'showname',
+          'hash', 'quality', 'episode', 'season', 'dir', 'state')
+# left out of cleaned() episodes
+PRIVATE_FIELDS = ('link', 'uid', 'showid', 'hash')
 
 
 class Episode(object):
+    # torrent and library are only set on episodes enriched for the API
+    __slots__ = FIELDS + ('torrent', 'library')
 
     def __init__(self, item=None, dir=None, **entries):
         self.title = None
@@ -61,16 +57,43 @@ class Episode(object):
             self.link = item["link"]
             self.uid = int(item["tv_episode_id"])
             self.showid = int(item["tv_show_id"])
-            self.showname = re.sub('[\\/:"*?<>|]+', '', item["tv_show_name"])
+            self.showname = normalize_name(item["tv_show_name"])
             self.hash = item["tv_info_hash"]
-            self.quality = getQuality(self.title)
-            self.episode = getNumbering(self.title)[1]
-            self.season = getNumbering(self.title)[0]
+            title = parse(self.title)
+            self.quality = title.quality
+            self.episode = title.episode
+            self.season = title.season
             if dir is not None:
                 self.dir = dir.format(seriesname=self.showname, seasonno=self.season)
 
         if entries:
-            self.__dict__.update(entries['entries'])
+            # db rows may carry columns that are not episode fields (next_check_at, ...)
+            for key, value in entries['entries'].items():
+                if key in FIELDS:
+                    setattr(self, key, value)
+
+    @classmethod
+    def from_row(cls, row):
+        # build straight from a db tuple row in FIELDS order
+        ep = cls.__new__(cls)
+        (ep.title, ep.published, ep.link, ep.uid, ep.showid, ep.showname,
+         ep.hash, ep.quality, ep.episode, ep.season, ep.dir, ep.state) = row
+        return ep
+
+    def as_row(self):
+        return (self.title, self.published, self.link, self.uid, self.showid, self.showname,
+                self.hash, self.quality, self.episode, self.season, self.dir, self.state)
+
+    def as_dict(self):
+        return dict(zip(FIELDS, self.as_row()))
+
+    def serialize(self):
+        d = self.as_dict()
+        for key in ('torrent', 'library'):
+            if hasattr(self, key):
+                value = getattr(self, key)
+                d[key] = value.serialize() if hasattr(value, 'serialize') else value
+        return d
 
     def __str__(self):
         if self.showname is not None:
@@ -80,12 +103,10 @@ class Episode(object):
             return "None type"
 
     def cleaned(self):
-        ep = self
-        del ep.link
-        del ep.uid
-        del ep.showid
-        del ep.hash
-        return ep
+        d = self.serialize()
+        for key in PRIVATE_FIELDS:
+            del d[key]
+        return d
 
     def set_dir(self, dir):
-        self.dir = dir.format(seriesname=re.sub('[\\/:"*?<>|]+', '', self.showname), seasonno=self.season)
+        self.dir = dir.format(seriesname=normalize_name(self.showname), seasonno=self.season)
@@ -1,16 +1,30 @@
+import codecs
+import json
 import logging
-import re
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
 from kodipydent import Kodi
 
+from .titleparser import normalize_name
+
 
 log = logging.getLogger(__name__)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 log.setLevel(logging.WARNING)
 
+PROPERTIES = ['showtitle', 'tvshowid', 'season', 'episode', 'title', 'dateadded', 'playcount',
+              'runtime', 'lastplayed', 'resume', 'art', 'fanart', 'thumbnail', 'file']
+DATEFMT = '%Y-%m-%d %H:%M:%S'
+# a scan younger than this may not show up in Library.IsScanningVideo yet
+SCAN_SETTLE = 5
+
 
 class Video(object):
 
     def __init__(self, map):
+        self.episodeid = map.get('episodeid', None)
         self.showtitle = map['showtitle']
         self.title = map['title']
         self.tvshowid = map['tvshowid']
@@ -26,6 +40,9 @@ class Video(object):
         self.lastplayed = map['lastplayed']
         self.resume = map['resume']
 
+    def serialize(self):
+        return dict(self.__dict__)
+
     def __str__(self):
         if self.file is not None:
             return "{:<16s} {:<16s} S{:02d}E{:02d} {:s}".format(
@@ -34,40 +51,403 @@ class Video(object):
             return "None type"
 
 
+class ScanCoordinator(object):
+    """
+    Library scans requested for many directories are collapsed to their
+    common ancestor (never above root, the whole library if there is no
+    root), with at most one scan in flight and a cool-down between scans.
+    A directory scanned less than rescan_interval ago is not scanned again.
+    Paths are kodi paths (smb://, nfs://, ...), so no os.path here.
+    """
+
+    def __init__(self, kodi, root=None, cooldown=60, rescan_interval=900, timeout=3600):
+        self.kd = kodi
+        self.root = self.dirpath(root) if root else None
+        self.cooldown = cooldown
+        self.rescan_interval = rescan_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.scanning = None        # paths of the scan in flight
+        self.scan_started = 0
+        self.scan_finished = 0
+        self.scanned = {}           # path -> time its last scan finished
+        self.scans = 0
+
+    @staticmethod
+    def dirpath(path):
+        return path.rstrip('/') + '/'
+
+    def request(self, path):
+        path = self.dirpath(path)
+        with self.lock:
+            if path in self.pending or self.covered(path, self.pending):
+                return False
+            if self.scanning is not None and self.covered(path, self.scanning):
+                return False
+            if time.time() - self.scanned.get(path, 0) < self.rescan_interval:
+                return False
+            self.pending.add(path)
+        return True
+
+    @staticmethod
+    def covered(path, parents):
+        return any(path.startswith(p) for p in parents)
+
+    def collapse(self, paths):
+        # one directory covering all paths, None for the whole library
+        paths = sorted(paths)
+        if len(paths) == 1:
+            return paths[0]
+        common = []
+        for parts in zip(*[p.split('/') for p in paths]):
+            if len(set(parts)) > 1:
+                break
+            common.append(parts[0])
+        common = '/'.join(common) + '/'
+        if self.root is not None and common.startswith(self.root):
+            return common
+        return self.root
+
+    def is_scanning(self):
+        rsp = self.kd.XBMC.GetInfoBooleans(booleans=['Library.IsScanningVideo'])
+        return bool(rsp['result'].get('Library.IsScanningVideo'))
+
+    def tick(self):
+        """
+        Check the scan in flight and start the next one when allowed.
+        Returns True if a scan finished since the last tick.
+        """
+        finished = False
+        now = time.time()
+        with self.lock:
+            if self.scanning is not None:
+                # the scan may not have started yet on the first check
+                age = now - self.scan_started
+                if age > self.timeout or (age >= SCAN_SETTLE and not self.is_scanning()):
+                    log.debug('library scan finished: %s', ', '.join(self.scanning))
+                    for path in self.scanning:
+                        self.scanned[path] = now
+                    self.scanning = None
+                    self.scan_finished = now
+                    finished = True
+                else:
+                    return False
+            if not self.pending or now - self.scan_finished < self.cooldown:
+                return finished
+            directory = self.collapse(self.pending)
+            log.debug('library scan %s for %d paths', directory or 'all', len(self.pending))
+            rsp = self.kd.VideoLibrary.Scan(directory=directory) if directory else self.kd.VideoLibrary.Scan()
+            if rsp.get('result') != 'OK':
+                log.warn('kodi refused library scan of {0} [{1}]'.format(directory, rsp))
+                return finished
+            self.scanning = list(self.pending)
+            self.pending = set()
+            self.scan_started = now
+            self.scans += 1
+        return finished
+
+
+class KodiListener(threading.Thread):
+    """
+    Reads the notifications kodi pushes on its raw TCP JSON-RPC socket
+    (port 9090 by default) and hands them to callback(method, data).
+    Reconnects with backoff; on_state(connected) tells when notifications
+    may have been missed.
+    """
+
+    def __init__(self, host, port, callback, on_state=None):
+        threading.Thread.__init__(self, name='kodi-listener')
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.callback = callback
+        self.on_state = on_state
+        self.connected = False
+        self.stopped = threading.Event()
+        self.sock = None
+
+    def stop(self):
+        self.stopped.set()
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        delay = 1
+        while not self.stopped.is_set():
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=10)
+                self.sock.settimeout(None)
+                log.debug('listening to kodi notifications on %s:%d', self.host, self.port)
+                self.setConnected(True)
+                delay = 1
+                self.read()
+            except (OSError, ValueError) as e:
+                log.debug('kodi notification socket error [%s]', e)
+            finally:
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                self.setConnected(False)
+            self.stopped.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def setConnected(self, connected):
+        if connected != self.connected:
+            self.connected = connected
+            if self.on_state:
+                self.on_state(connected)
+
+    def read(self):
+        # kodi writes json objects back to back, without any delimiter
+        decoder = json.JSONDecoder()
+        # characters may be split between two reads
+        utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buf = ''
+        while not self.stopped.is_set():
+            data = self.sock.recv(65536)
+            if not data:
+                return
+            buf += utf8.decode(data)
+            while True:
+                buf = buf.lstrip()
+                if not buf:
+                    break
+                try:
+                    msg, end = decoder.raw_decode(buf)
+                except ValueError:
+                    if len(buf) > 1 << 20:
+                        raise
+                    break   # incomplete object, wait for more data
+                buf = buf[end:]
+                if isinstance(msg, dict) and 'method' in msg and 'id' not in msg:
+                    try:
+                        self.callback(msg['method'], msg.get('params', {}).get('data'))
+                    except Exception as e:
+                        log.error('error handling kodi notification {0} [{1}]'.format(msg['method'], e))
+
+
 class KodiDB(object):
-    def __init__(self, config):
+    """
+    Kodi video library access. Episodes are looked up in an in-memory
+    show -> season -> episode index that refresh() keeps up to date.
+    """
+    def __init__(self, config, library_root=None):
         log.debug("init: %s:%d u:%s", config['host'], config['port'], config['username'])
         self.kd = Kodi(hostname=config['host'], port=config['port'],
                        username=config['username'], password=config['password'])
+        self.full_refresh_interval = config.get('full_refresh_interval', 3600)
+        # items changed this long before the newest known change are fetched again,
+        # dateadded comes from file times and does not grow strictly with scans
+        self.refresh_margin = config.get('refresh_margin', 86400)
 
-    def getVideo(self, show, season, episode):
+        self.lock = threading.Lock()
+        self.shows = {}     # tvshowid -> show name
+        self.index = {}     # tvshowid -> season -> episode -> Video
+        self.watermark = None
+        self.last_full_refresh = 0
+        # (tvshowid, season, episode) added or changed since takeUpdated(), None: all of them
+        self.updated = None
+        self.scans = ScanCoordinator(self.kd, library_root, config.get('scan_cooldown', 60),
+                                     config.get('rescan_interval', 900), config.get('scan_timeout', 3600))
+
+        # with notifications the index is patched per changed episode, and only
+        # polled for changes every fallback_interval
+        self.host = config['host']
+        self.tcp_port = config.get('tcp_port', 9090)
+        self.fallback_interval = config.get('fallback_interval', 900)
+        self.listener = None
+        self.on_change = None
+        # a library scan sends one OnUpdate per episode, on_change runs once per notify_delay
+        self.notify_delay = config.get('notify_delay', 2)
+        self.notify_timer = None
+        self.changed = set()    # episode ids notified since the last refresh
+        self.stale = True       # notifications may have been missed
+        self.last_refresh = 0
+
+    def listen(self, on_change=None):
+        # start the notification listener, on_change() is called for every relevant notification
+        self.on_change = on_change
+        self.listener = KodiListener(self.host, self.tcp_port, self.onNotification, self.onListenerState)
+        self.listener.start()
+
+    def stopListening(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        with self.lock:
+            timer, self.notify_timer = self.notify_timer, None
+        if timer is not None:
+            timer.cancel()
+
+    def isListening(self):
+        return self.listener is not None and self.listener.connected
+
+    def onListenerState(self, connected):
+        log.debug('kodi notifications %s', 'connected' if connected else 'disconnected')
+        with self.lock:
+            self.stale = True
+
+    def onNotification(self, method, data):
+        item = data.get('item', {}) if isinstance(data, dict) else {}
+        if method in ('VideoLibrary.OnUpdate', 'Player.OnStop') and item.get('type') == 'episode' and 'id' in item:
+            with self.lock:
+                self.changed.add(item['id'])
+        elif method == 'VideoLibrary.OnScanFinished':
+            with self.lock:
+                self.stale = True
+        else:
+            return
+        log.debug('kodi notification %s %s', method, data)
+        if not self.on_change:
+            return
+        if self.notify_delay <= 0:
+            self.on_change()
+            return
+        with self.lock:
+            if self.notify_timer is not None:
+                return
+            self.notify_timer = threading.Timer(self.notify_delay, self.notifyChange)
+            self.notify_timer.daemon = True
+            self.notify_timer.start()
+
+    def notifyChange(self):
+        with self.lock:
+            self.notify_timer = None
+        self.on_change()
+
+    def refresh(self):
+        self.tickScans()
         try:
-            log.debug('get video %s S%02dE%02d', show, season, episode)
-            srsp = self.kd.VideoLibrary.GetTVShows()
-            for s in srsp['result']['tvshows']:
-                showname = re.sub('[\\/:"*?<>|]+', '', s["label"])
-                if showname.lower().startswith(show.lower()):
-                    log.debug('get video rsp: found show %s', s)
-                    ersp = self.kd.VideoLibrary.GetEpisodes(
-                            tvshowid=s['tvshowid'], season=season,
-                            properties=['showtitle', 'tvshowid', 'season', 'episode', 'title', 'dateadded', 'playcount',
-                                        'runtime', 'lastplayed', 'resume', 'art', 'fanart', 'thumbnail', 'file'])
-                    for e in ersp['result']['episodes']:
-                        # log.debug(e['episode'])
-                        if e['episode'] == episode:
-                            log.debug('get video rsp: found episode %s', e['file'])
-                            return Video(e)
-        except Exception:
-            pass
+            now = time.time()
+            with self.lock:
+                changed, self.changed = self.changed, set()
+                stale = self.stale or not self.isListening() or now - self.last_refresh >= self.fallback_interval
+                self.stale = False
+            if now - self.last_full_refresh >= self.full_refresh_interval:
+                self.refreshAll()
+            elif stale:
+                self.refreshChanged()
+            elif changed:
+                self.refreshEpisodes(changed)
+            if stale:
+                self.last_refresh = now
+            return True
+        except Exception as e:
+            log.error('cannot refresh kodi library index [{0}]'.format(e))
+            with self.lock:
+                self.stale = True
+        return False
+
+    def refreshEpisodes(self, episodeids):
+        log.debug('refresh library episodes %s', sorted(episodeids))
+        videos = []
+        for episodeid in episodeids:
+            ersp = self.kd.VideoLibrary.GetEpisodeDetails(episodeid=episodeid, properties=PROPERTIES)
+            details = ersp.get('result', {}).get('episodedetails')
+            if details:
+                videos.append(Video(details))
+        self.updateIndex(videos)
+
+    def refreshAll(self):
+        log.debug('refresh library index')
+        shows = self.getShows()
+        ersp = self.kd.VideoLibrary.GetEpisodes(properties=PROPERTIES)
+        index = {}
+        for e in ersp['result'].get('episodes', []):
+            v = Video(e)
+            index.setdefault(v.tvshowid, {}).setdefault(v.season, {})[v.episode] = v
+        with self.lock:
+            if not self.index:
+                self.updated = None
+            elif self.updated is not None:
+                self.updated.update(self.diffIndex(v for seasons in index.values()
+                                                   for episodes in seasons.values() for v in episodes.values()))
+            self.shows = shows
+            self.index = index
+            self.watermark = self.getWatermark(v for seasons in index.values()
+                                               for episodes in seasons.values() for v in episodes.values())
+            self.last_full_refresh = time.time()
+
+    def refreshChanged(self):
+        since = (self.watermark - timedelta(seconds=self.refresh_margin)).strftime(DATEFMT)
+        log.debug('refresh library index since %s', since)
+        ersp = self.kd.VideoLibrary.GetEpisodes(
+                properties=PROPERTIES,
+                filter={'or': [{'field': 'dateadded', 'operator': 'after', 'value': since},
+                               {'field': 'lastplayed', 'operator': 'after', 'value': since}]})
+        self.updateIndex([Video(e) for e in ersp['result'].get('episodes', [])])
+
+    def updateIndex(self, videos):
+        shows = None
+        if any(v.tvshowid not in self.shows for v in videos):
+            shows = self.getShows()
+        with self.lock:
+            if shows is not None:
+                self.shows = shows
+            if self.updated is not None:
+                self.updated.update(self.diffIndex(videos))
+            for v in videos:
+                self.index.setdefault(v.tvshowid, {}).setdefault(v.season, {})[v.episode] = v
+            self.watermark = max(self.watermark, self.getWatermark(videos))
+
+    def diffIndex(self, videos):
+        # keys of the videos that are new or changed compared to the index, callers hold lock
+        for v in videos:
+            old = self.index.get(v.tvshowid, {}).get(v.season, {}).get(v.episode, None)
+            if old is None or old.file != v.file or old.playcount != v.playcount:
+                yield (v.tvshowid, v.season, v.episode)
+
+    def takeUpdated(self):
+        """
+        (show name, season, episode) of the library episodes added or changed
+        since the last call, None if the whole library has to be considered
+        """
+        with self.lock:
+            updated, self.updated = self.updated, set()
+            if updated is None:
+                return None
+            return [(self.shows.get(tvshowid, ''), season, episode) for tvshowid, season, episode in updated]
+
+    def getShows(self):
+        srsp = self.kd.VideoLibrary.GetTVShows()
+        return {s['tvshowid']: normalize_name(s['label']).lower() for s in srsp['result'].get('tvshows', [])}
+
+    def getWatermark(self, videos):
+        # newest dateadded/lastplayed, as reported by kodi
+        newest = datetime.min + timedelta(seconds=self.refresh_margin)
+        for v in videos:
+            for d in (v.dateadded, v.lastplayed):
+                try:
+                    newest = max(newest, datetime.strptime(d, DATEFMT))
+                except (TypeError, ValueError):
+                    pass
+        return newest
+
+    def getVideo(self, show, season, episode):
+        log.debug('get video %s S%02dE%02d', show, season, episode)
+        show = show.lower()
+        with self.lock:
+            for tvshowid, showname in self.shows.items():
+                if showname.startswith(show):
+                    v = self.index.get(tvshowid, {}).get(season, {}).get(episode, None)
+                    if v is not None:
+                        log.debug('get video rsp: found episode %s', v.file)
+                        return v
         return None
 
     def updateLibPath(self, path):
+        # queue a library scan, started by tickScans(); False if already pending or recently scanned
+        log.debug('update library path %s', path)
+        return self.scans.request(path)
+
+    def tickScans(self):
         try:
-            log.debug('update library path %s', path)
-            rsp = self.kd.VideoLibrary.Scan(directory=path)
-            log.debug('update library rsp: %s', rsp['result'])
-            if rsp['result'] == 'OK':
-                return True
-        except KeyError:
-            pass
+            return self.scans.tick()
+        except Exception as e:
+            log.error('cannot check kodi library scan [{0}]'.format(e))
         return False
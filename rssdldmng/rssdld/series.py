@@ -0,0 +1,61 @@
+import re
+import logging
+from functools import lru_cache
+
+from .titleparser import normalize_name
+
+log = logging.getLogger(__name__)
+
+YEAR = re.compile(r'\s*\((?:19|20)[0-9]{2}\)\s*$')
+POSSESSIVE = re.compile(r"['`’]s\b")
+NONWORD = re.compile(r'[^a-z0-9]+')
+
+
+@lru_cache(maxsize=8192)
+def canonical(name):
+    """
+    Canonical form of a show name, the same for the usual variants:
+    "Marvel's Agents of S.H.I.E.L.D." / "Marvels Agents of S H I E L D",
+    "Doctor Who (2005)" / "Doctor Who", "Law & Order" / "Law and Order".
+    """
+    name = normalize_name(name or '').lower()
+    name = YEAR.sub('', name)
+    name = POSSESSIVE.sub('s', name)
+    name = name.replace('&', ' and ')
+    return ' '.join(NONWORD.sub(' ', name).split())
+
+
+class SeriesIndex(object):
+    """
+    Set of wanted series, keyed by canonical name, with aliases from the
+    config and from showrss show ids.
+    """
+
+    def __init__(self, names, aliases=None, showids=None):
+        self.names = sorted(set(normalize_name(n).lower() for n in names))
+        self.keys = frozenset(canonical(n) for n in names)
+        # alias name -> canonical name of a wanted series
+        self.aliases = {}
+        for alias, name in (aliases or {}).items():
+            if canonical(name) in self.keys:
+                self.aliases[canonical(alias)] = canonical(name)
+        # showrss tv_show_id -> canonical name, learned from matched episodes
+        self.showids = {}
+        for showid, name in showids or []:
+            self.learn(showid, name)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def learn(self, showid, name):
+        key = canonical(name)
+        key = self.aliases.get(key, key)
+        if showid and key in self.keys:
+            self.showids[showid] = key
+            return True
+        return False
+
+    def match(self, ep):
+        if ep.showid and ep.showid in self.showids:
+            return True
+        return self.learn(ep.showid, ep.showname)
@@ -1,106 +1,421 @@
 import logging
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
 
 from ..pysqlw import pysqlw
-from .episode import Episode
+from .episode import Episode, FIELDS
 
 log = logging.getLogger(__name__)
 logging.getLogger("sqlitew").setLevel(logging.WARNING)
 
+# Ordered schema upgrade steps: (version, description, [sql statement or callable(dbc), ...]).
+# Every step of a version runs in one transaction; released versions must never be edited,
+# append a new version instead.
+MIGRATIONS = [
+    (1, 'create episodes table', [
+        ''' CREATE TABLE IF NOT EXISTS `episodes` (
+                `title`     TEXT,
+                `published` NUMERIC,
+                `link`      TEXT,
+                `uid`       INTEGER,
+                `showid`    INTEGER,
+                `showname`  TEXT,
+                `hash`      TEXT,
+                `quality`   TEXT,
+                `episode`   INTEGER,
+                `season`    INTEGER,
+                `dir`       TEXT,
+                `state`     INTEGER,
+                PRIMARY KEY(`hash`));''',
+    ]),
+    (2, 'index episodes on state, published and numbering', [
+        'CREATE INDEX IF NOT EXISTS `episodes_state` ON `episodes` (`state`)',
+        'CREATE INDEX IF NOT EXISTS `episodes_published` ON `episodes` (`published`)',
+        'CREATE INDEX IF NOT EXISTS `episodes_numbering` ON `episodes` (`showname`, `season`, `episode`)',
+    ]),
+    (3, 'create feeds fetch state table', [
+        ''' CREATE TABLE IF NOT EXISTS `feeds` (
+                `url`       TEXT,
+                `etag`      TEXT,
+                `modified`  TEXT,
+                `digest`    TEXT,
+                `filters`   TEXT,
+                `checked`   NUMERIC,
+                PRIMARY KEY(`url`));''',
+    ]),
+    (4, 'create trakt outbox table', [
+        ''' CREATE TABLE IF NOT EXISTS `trakt_outbox` (
+                `id`            INTEGER PRIMARY KEY AUTOINCREMENT,
+                `action`        TEXT,
+                `showname`      TEXT,
+                `season`        INTEGER,
+                `episode`       INTEGER,
+                `queued`        NUMERIC,
+                `attempts`      INTEGER DEFAULT 0,
+                `next_attempt`  NUMERIC DEFAULT 0);''',
+        'CREATE INDEX IF NOT EXISTS `trakt_outbox_next_attempt` ON `trakt_outbox` (`next_attempt`)',
+    ]),
+    (5, 'index episodes on (published, hash) for keyset pagination', [
+        # NULLs would fall out of the keyset comparisons
+        'UPDATE `episodes` SET `published` = 0 WHERE `published` IS NULL',
+        'DROP INDEX IF EXISTS `episodes_published`',
+        'CREATE INDEX IF NOT EXISTS `episodes_published_hash` ON `episodes` (`published`, `hash`)',
+    ]),
+    (6, 'schedule episode checks and log state transitions', [
+        # new episodes are due right away
+        'ALTER TABLE `episodes` ADD COLUMN `next_check_at` NUMERIC DEFAULT 0',
+        # NONE (1) and WATCHED (37) are never checked
+        'UPDATE `episodes` SET `next_check_at` = NULL WHERE `state` IN (1, 37)',
+        'CREATE INDEX IF NOT EXISTS `episodes_next_check_at` ON `episodes` (`next_check_at`)',
+        ''' CREATE TABLE IF NOT EXISTS `transitions` (
+                `id`            INTEGER PRIMARY KEY AUTOINCREMENT,
+                `hash`          TEXT,
+                `from_state`    INTEGER,
+                `to_state`      INTEGER,
+                `timestamp`     NUMERIC,
+                `cause`         TEXT);''',
+        'CREATE INDEX IF NOT EXISTS `transitions_hash` ON `transitions` (`hash`)',
+    ]),
+]
 
-class DBO():
 
-    def __init__(self, db_path):
-        self.db = pysqlw(db_type='sqlite', db_path=db_path)
-
-    def __enter__(self):
-        return self.db
+class _Connection(object):
+    # per thread holder of a connection, dropped with the thread's locals when the thread ends
+    __slots__ = ('db', '__weakref__')
 
-    def __exit__(self, type, value, traceback):
-        self.db.close()
+    def __init__(self, db):
+        self.db = db
 
 
 class ShowsDB(object):
+    """
+    Episodes database. Keeps one sqlite connection per thread (downloader
+    thread, REST handler threads, ...) until the thread ends or the db is
+    closed.
+    """
 
     def __init__(self, db_path):
         self.table = 'episodes'
+        self.columns = ', '.join('`{0}`'.format(f) for f in FIELDS)
         self.db_path = db_path
-        self.createDB()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.conns = []
+        # episodes per state, loaded on open and kept up to date by the write methods
+        self.stats_lock = threading.Lock()
+        self.stats = Counter()
+
+    def open(self):
+        self.connection().wrapper.cursor.execute('PRAGMA journal_mode=WAL').fetchall()
+        self.migrate()
+        self.loadStats()
+        log.debug('opened db %s', self.db_path)
+
+    def close(self):
+        with self.lock:
+            conns = self.conns
+            self.conns = []
+            local, self.local = self.local, threading.local()
+        # dropping the locals runs the finalizers, which take the lock
+        del local
+        for db in conns:
+            db.close()
+        log.debug('closed db %s [%d connections]', self.db_path, len(conns))
 
-    def createDB(self):
-        with DBO(self.db_path) as db:
-            # db.wrapper.cursor.execute('DROP TABLE `{table}`'.format(table=self.table))
+    def connection(self):
+        # connections are created with check_same_thread=False only so that
+        # close() can tear them down from the owning (downloader) thread
+        local = self.local
+        holder = getattr(local, 'conn', None)
+        if holder is None:
+            db = pysqlw(db_type='sqlite', db_path=self.db_path, check_same_thread=False)
+            db.wrapper.cursor.execute('PRAGMA synchronous=NORMAL')
+            holder = local.conn = _Connection(db)
+            with self.lock:
+                self.conns.append(db)
+            # short-lived threads (one per http connection) must not leave their connection behind
+            weakref.finalize(holder, self._release, db)
+        # a query that raised may have left where() clauses behind
+        return holder.db._reset()
+
+    def _release(self, db):
+        with self.lock:
+            if db not in self.conns:
+                # already closed by close()
+                return
+            self.conns.remove(db)
+        db.close()
+
+    def migrate(self):
+        dbc = self.connection().wrapper.dbc
+        dbc.execute('CREATE TABLE IF NOT EXISTS `schema_version` (`version` INTEGER PRIMARY KEY, `applied` NUMERIC)')
+        dbc.commit()
+        current = dbc.execute('SELECT MAX(`version`) AS `version` FROM `schema_version`').fetchall()[0]['version'] or 0
+        for version, description, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            log.info('migrating db to version %d: %s', version, description)
             try:
-                db.get(self.table)
+                dbc.execute('BEGIN')
+                for step in steps:
+                    if callable(step):
+                        step(dbc)
+                    else:
+                        dbc.execute(step)
+                dbc.execute('INSERT INTO `schema_version` (`version`, `applied`) VALUES (?, ?)', (version, int(time.time())))
+                dbc.commit()
             except Exception:
-                db.wrapper.cursor.execute(
-                    ''' CREATE TABLE `{table}` (
-                            `title`     TEXT,
-                            `published` NUMERIC,
-                            `link`      TEXT,
-                            `uid`       INTEGER,
-                            `showid`    INTEGER,
-                            `showname`  TEXT,
-                            `hash`      TEXT,
-                            `quality`   TEXT,
-                            `episode`   INTEGER,
-                            `season`    INTEGER,
-                            `dir`       TEXT,
-                            `state`     INTEGER,
-                            PRIMARY KEY(`hash`));'''
-                    .format(table=self.table))
-                db.wrapper.dbc.commit()
+                dbc.rollback()
+                log.error('migration to db version %d failed', version)
+                raise
+            current = version
+        return current
+
+    def maintenance(self):
+        dbc = self.connection().wrapper.dbc
+        dbc.execute('PRAGMA optimize').fetchall()
+        dbc.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        log.debug('db maintenance done')
+
+    def loadStats(self):
+        rows = self.connection().wrapper.dbc.execute(
+            'SELECT `state`, COUNT(*) AS `count` FROM `{0}` GROUP BY `state`'.format(self.table)).fetchall()
+        with self.stats_lock:
+            self.stats = Counter({row['state']: row['count'] for row in rows})
+
+    def getStats(self):
+        # {state: count}, without touching the db
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def _countState(self, old, new):
+        # callers hold stats_lock
+        if old is not None:
+            self.stats[old] -= 1
+        if new is not None:
+            self.stats[new] += 1
+
+    def _getState(self, ihash, db):
+        rows = db.wrapper.dbc.execute('SELECT `state` FROM `{0}` WHERE `hash` = ?'.format(self.table), (ihash,)).fetchall()
+        return rows[0]['state'] if rows else None
 
     def hasEpisode(self, ihash, db):
-        if db.where('hash', ihash).get(self.table):
+        if db.where('hash', ihash).get(self.table, 1):
             return True
         return False
 
     def addEpisode(self, item):
-        with DBO(self.db_path) as db:
+        db = self.connection()
+        with self.stats_lock:
             if not self.hasEpisode(item.hash, db):
-                db.insert(self.table, item.__dict__)
+                db.insert(self.table, item.as_dict())
+                self._countState(None, item.state)
                 return item
         return None
 
+    def addEpisodes(self, items):
+        # bulk insert in a single transaction, returns the items that were not already in db
+        items = OrderedDict((item.hash, item) for item in items)
+        if not items:
+            return []
+        dbc = self.connection().wrapper.dbc
+        with self.stats_lock, dbc:
+            hashes = list(items.keys())
+            existing = set()
+            # stay below SQLITE_MAX_VARIABLE_NUMBER
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                rows = dbc.execute('SELECT `hash` FROM `{table}` WHERE `hash` IN ({params})'.format(
+                    table=self.table, params=', '.join('?' * len(chunk))), chunk)
+                existing.update(row['hash'] for row in rows)
+            added = [item for ihash, item in items.items() if ihash not in existing]
+            dbc.executemany('INSERT OR IGNORE INTO `{table}` ({columns}) VALUES ({params})'.format(
+                table=self.table, columns=self.columns, params=', '.join('?' * len(FIELDS))),
+                [item.as_row() for item in added])
+            for item in added:
+                self._countState(None, item.state)
+        return added
+
     def updateEpisode(self, item):
-        with DBO(self.db_path) as db:
-            if self.hasEpisode(item.hash, db):
-                db.where('hash', item.hash).update(self.table, item.__dict__)
+        db = self.connection()
+        with self.stats_lock:
+            old = self._getState(item.hash, db)
+            if old is not None:
+                db.where('hash', item.hash).update(self.table, item.as_dict())
             else:
-                db.insert(self.table, item.__dict__)
+                db.insert(self.table, item.as_dict())
+            self._countState(old, item.state)
+
+    def updateEpisodeState(self, item, state, cause=None, next_check_at=0):
+        # state change, logged in transitions; next_check_at None: never checked again
+        dbc = self.connection().wrapper.dbc
+        with self.stats_lock, dbc:
+            rows = dbc.execute('SELECT `state` FROM `{0}` WHERE `hash` = ?'.format(self.table), (item.hash,)).fetchall()
+            if not rows:
+                return False
+            old = rows[0]['state']
+            item.state = state
+            dbc.execute('UPDATE `{0}` SET `state` = ?, `next_check_at` = ? WHERE `hash` = ?'.format(self.table),
+                        (state, next_check_at, item.hash))
+            if old != state:
+                dbc.execute('INSERT INTO `transitions` (`hash`, `from_state`, `to_state`, `timestamp`, `cause`) '
+                            'VALUES (?, ?, ?, ?, ?)', (item.hash, old, state, int(time.time()), cause))
+            self._countState(old, state)
+        return True
+
+    def getTransitions(self, ihash):
+        # state history of an episode, oldest first
+        return self.connection().wrapper.dbc.execute(
+            'SELECT `from_state`, `to_state`, `timestamp`, `cause` FROM `transitions` WHERE `hash` = ? ORDER BY `id`',
+            (ihash,)).fetchall()
 
-    def updateEpisodeState(self, item, state):
-        with DBO(self.db_path) as db:
-            if self.hasEpisode(item.hash, db):
-                item.state = state
-                db.where('hash', item.hash).update(self.table, item.__dict__)
+    def getDueEpisodes(self, now=None):
+        # episodes whose next check is due, by state
+        where = ' WHERE `next_check_at` <= ? ORDER BY `state`'
+        return [Episode.from_row(row) for row in self.query(where, (int(now if now is not None else time.time()),))]
+
+    def scheduleEpisodes(self, schedule):
+        # [(next_check_at, hash)]
+        dbc = self.connection().wrapper.dbc
+        with dbc:
+            dbc.executemany('UPDATE `{0}` SET `next_check_at` = ? WHERE `hash` = ?'.format(self.table), schedule)
+
+    def markEpisodesDue(self, hashes=(), states=()):
+        # make episodes of the given torrent hashes or states due now, unless never checked
+        hashes = list(set(h for ihash in hashes for h in (ihash.lower(), ihash.upper())))
+        dbc = self.connection().wrapper.dbc
+        count = 0
+        with dbc:
+            for column, values in (('hash', hashes), ('state', list(states))):
+                # stay below SQLITE_MAX_VARIABLE_NUMBER
+                for i in range(0, len(values), 500):
+                    chunk = values[i:i + 500]
+                    count += dbc.execute(
+                        'UPDATE `{table}` SET `next_check_at` = 0 WHERE `{column}` IN ({params}) '
+                        'AND `next_check_at` > 0'.format(table=self.table, column=column, params=', '.join('?' * len(chunk))),
+                        chunk).rowcount
+        return count
+
+    def query(self, where='', params=()):
+        # plain tuple rows, no per-row dict
+        cursor = self.connection().wrapper.dbc.cursor()
+        cursor.row_factory = None
+        return cursor.execute('SELECT {columns} FROM `{table}`{where}'.format(
+            columns=self.columns, table=self.table, where=where), params)
 
     def getEpisode(self, ihash):
-        with DBO(self.db_path) as db:
-            # log.debug('find hash %s', ihash)
-            rows = db.where('hash', ihash).get(self.table)
-            # log.debug(rows)
-            if rows:
-                return Episode(entries=rows[0])
+        for row in self.query(' WHERE `hash` = ? LIMIT 1', (ihash,)):
+            return Episode.from_row(row)
         return None
 
-        # create new db cursor so it could be acceseed from different thread
     def getEpisodes(self, state=-1, published=-1, showname=None, season=-1, episode=-1):
-        items = []
-        with DBO(self.db_path) as db:
-            dbreq = db
-            if state >= 0:
-                dbreq = dbreq.where('state', state)
-            if published >= 0:
-                dbreq = dbreq.where('published', published, '>')
-            if showname is not None:
-                dbreq = dbreq.where('showname', showname)
-            if season >= 0:
-                dbreq = dbreq.where('season', season)
-            if episode >= 0:
-                dbreq = dbreq.where('episode', episode)
-
-            rows = dbreq.get(self.table)
-            for row in rows:
-                items.append(Episode(entries=row))
-        return items
+        return list(self.iterEpisodes(state, published, showname, season, episode))
+
+    def iterEpisodes(self, state=-1, published=-1, showname=None, season=-1, episode=-1):
+        # episodes are built one by one while the cursor is read, for streaming large results
+        where, params = self.filters(state, published, showname, season, episode)
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        for row in self.query(where, params):
+            yield Episode.from_row(row)
+
+    def getEpisodePage(self, limit, after=None, fields=None, state=-1, published=-1, showname=None, season=-1, episode=-1):
+        """
+        One page of episodes, newest first, as dicts of the given fields (all by default).
+        after is the (published, hash) key of the last episode of the previous page.
+        Returns (episodes, key of the last episode or None if this is the last page).
+        """
+        fields = list(fields or FIELDS)
+        columns = fields + [f for f in ('published', 'hash') if f not in fields]
+        where, params = self.filters(state, published, showname, season, episode)
+        if after is not None:
+            where.append('(`published` < ? OR (`published` = ? AND `hash` < ?))')
+            params.extend([after[0], after[0], after[1]])
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        cursor = self.connection().wrapper.dbc.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute('SELECT {columns} FROM `{table}`{where} ORDER BY `published` DESC, `hash` DESC LIMIT ?'.format(
+            columns=', '.join('`{0}`'.format(c) for c in columns), table=self.table, where=where),
+            params + [limit + 1]).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        episodes = [dict(zip(fields, row)) for row in rows]
+        if not more:
+            return episodes, None
+        last = dict(zip(columns, rows[-1]))
+        return episodes, (last['published'], last['hash'])
+
+    def filters(self, state=-1, published=-1, showname=None, season=-1, episode=-1):
+        where = []
+        params = []
+        if state >= 0:
+            where.append('`state` = ?')
+            params.append(state)
+        if published >= 0:
+            where.append('`published` > ?')
+            params.append(published)
+        if showname is not None:
+            where.append('`showname` = ?')
+            params.append(showname)
+        if season >= 0:
+            where.append('`season` = ?')
+            params.append(season)
+        if episode >= 0:
+            where.append('`episode` = ?')
+            params.append(episode)
+        return where, params
+
+    def getShowIds(self):
+        # (showrss show id, show name) pairs of the episodes already accepted
+        rows = self.connection().wrapper.dbc.execute(
+            'SELECT DISTINCT `showid`, `showname` FROM `{table}` WHERE `showid` > 0'.format(table=self.table))
+        return [(row['showid'], row['showname']) for row in rows]
+
+    def getFeedState(self, url):
+        rows = self.connection().where('url', url).get('feeds', 1)
+        if rows:
+            return rows[0]
+        return {}
+
+    def setFeedState(self, url, state):
+        state = dict(state, url=url, checked=int(time.time()))
+        db = self.connection()
+        if not db.where('url', url).update('feeds', state):
+            db.insert('feeds', state)
+
+    def queueTraktUpdate(self, action, showname, season, episode):
+        now = int(time.time())
+        self.connection().insert('trakt_outbox', {'action': action, 'showname': showname, 'season': season,
+                                                  'episode': episode, 'queued': now, 'next_attempt': now})
+
+    def getTraktUpdates(self, limit=100):
+        # outbox entries due now, oldest first
+        return self.connection().wrapper.dbc.execute(
+            'SELECT * FROM `trakt_outbox` WHERE `next_attempt` <= ? ORDER BY `id` LIMIT ?',
+            (int(time.time()), limit)).fetchall()
+
+    def deleteTraktUpdates(self, ids):
+        dbc = self.connection().wrapper.dbc
+        with dbc:
+            dbc.executemany('DELETE FROM `trakt_outbox` WHERE `id` = ?', [(i,) for i in ids])
+
+    def deferTraktUpdates(self, ids, backoff, max_backoff, max_attempts=None):
+        """
+        Retry after backoff * 2^attempts seconds, capped at max_backoff. Entries
+        that failed max_attempts times are dropped; returns how many were.
+        """
+        dbc = self.connection().wrapper.dbc
+        with dbc:
+            # the exponent is capped, larger shifts overflow the 64 bit integers
+            dbc.executemany(
+                'UPDATE `trakt_outbox` SET `next_attempt` = ? + MIN(? << MIN(`attempts`, 16), ?), '
+                '`attempts` = `attempts` + 1 WHERE `id` = ?', [(int(time.time()), backoff, max_backoff, i) for i in ids])
+            if max_attempts is None:
+                return 0
+            dropped = 0
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                dropped += dbc.execute('DELETE FROM `trakt_outbox` WHERE `attempts` >= ? AND `id` IN ({0})'.format(
+                    ', '.join('?' * len(chunk))), [max_attempts] + chunk).rowcount
+            return dropped
@@ -0,0 +1,103 @@
+import logging
+import time
+
+from .episode import IState
+
+log = logging.getLogger(__name__)
+
+# allowed automatic transitions and what causes them
+TRANSITIONS = {
+    (IState.NEW.value, IState.DOWNLOADING.value): 'added to transmission',
+    (IState.NEW.value, IState.AVAILABLE.value): 'already in library',
+    (IState.DOWNLOADING.value, IState.FINISHED.value): 'download complete',
+    (IState.FINISHED.value, IState.UPDATING.value): 'library scan requested',
+    (IState.UPDATING.value, IState.AVAILABLE.value): 'found in library',
+    (IState.AVAILABLE.value, IState.WATCHED.value): 'played',
+}
+# manual transitions (API) may go anywhere
+MANUAL = 'manual'
+
+# seconds until an episode that stays in a state is checked again when no event
+# (torrent activity, library change) marks it due earlier; None: never
+CHECK_INTERVALS = {
+    IState.NONE.value: None,
+    IState.NEW.value: 0,                # retried every cycle until transmission takes it
+    IState.DOWNLOADING.value: 600,
+    IState.FINISHED.value: 3600,
+    IState.UPDATING.value: 900,         # library scans are requested again after the rescan interval
+    IState.AVAILABLE.value: 6 * 3600,
+    IState.WATCHED.value: None,
+}
+
+
+class StateMachine(object):
+    """
+    Episode lifecycle over IState. Every episode has a next_check_at; run()
+    only hands the episodes that are due to the handler of their state, so
+    the work of a cycle follows activity, not the size of the history.
+    Transitions are checked against TRANSITIONS and logged in the db.
+    """
+
+    def __init__(self, db, intervals=None):
+        self.db = db
+        self.intervals = dict(CHECK_INTERVALS)
+        # config overrides by state name, e.g. {"available": 3600}
+        for name, interval in (intervals or {}).items():
+            self.intervals[IState[name.upper()].value] = interval
+        self.handlers = {}
+
+    def handle(self, state, handler):
+        # handler(ep, *args) checks one due episode and calls transition() when it moves on
+        self.handlers[state.value if isinstance(state, IState) else state] = handler
+
+    def nextCheck(self, state, now=None):
+        interval = self.intervals.get(state)
+        if interval is None:
+            return None
+        return int(now if now is not None else time.time()) + interval
+
+    def allowed(self, old, new):
+        return (old, new) in TRANSITIONS
+
+    def transition(self, ep, state, cause=None):
+        """
+        Move ep to state; cause defaults to the TRANSITIONS description.
+        Returns False for transitions not in TRANSITIONS (unless manual).
+        """
+        if cause != MANUAL and not self.allowed(ep.state, state):
+            log.warning('invalid transition %s -> %s: %s S%02dE%02d', IState(ep.state).name, IState(state).name,
+                        ep.showname, ep.season, ep.episode)
+            return False
+        cause = cause or TRANSITIONS[(ep.state, state)]
+        log.debug('%-10s -> %-10s %s [%s]', IState(ep.state).name, IState(state).name, ep.showname, cause)
+        self.db.updateEpisodeState(ep, state, cause, self.nextCheck(state))
+        return True
+
+    def markDue(self, hashes):
+        # episodes of these torrents are checked in the next run
+        return self.db.markEpisodesDue(hashes=hashes)
+
+    def markStatesDue(self, states):
+        return self.db.markEpisodesDue(states=[s.value if isinstance(s, IState) else s for s in states])
+
+    def run(self, *args):
+        """
+        Check the due episodes, returns how many were checked. An episode
+        that moves on is handled again in its new state within the same run.
+        """
+        now = int(time.time())
+        episodes = self.db.getDueEpisodes(now)
+        unchanged = []
+        for ep in episodes:
+            # bounded, every transition moves forward
+            for _ in range(len(TRANSITIONS)):
+                state = ep.state
+                handler = self.handlers.get(state)
+                if handler is not None:
+                    handler(ep, *args)
+                if ep.state == state:
+                    unchanged.append((self.nextCheck(state, now), ep.hash))
+                    break
+        # checked without moving on: due again after the state's interval
+        self.db.scheduleEpisodes(unchanged)
+        return len(episodes)
@@ -0,0 +1,61 @@
+import re
+import logging
+from collections import namedtuple
+from datetime import date
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+
+QUALITIES = ('480p', '720p', '1080p', '2160p')
+
+# characters not allowed in file names, removed from show names
+INVALID_CHARS = re.compile('[\\\\/:"*?<>|]+')
+
+# every token we are interested in, matched in a single scan of the title
+TOKENS = re.compile(r'''
+      S(?P<season>\d{1,2})[ .]?E(?P<episode>\d{1,3})(?:(?:-?E|-)(?P<last>\d{1,3}))?
+    | (?<![0-9])(?P<xseason>\d{1,2})x(?P<xepisode>\d{2,3})(?:-(?:\d{1,2}x)?(?P<xlast>\d{2,3}))?(?![0-9])
+    | (?<![0-9])(?P<year>(?:19|20)\d{2})[ .-](?P<month>0[1-9]|1[0-2])[ .-](?P<day>0[1-9]|[12][0-9]|3[01])(?![0-9])
+    | (?P<quality>480p|720p|1080p|2160p)
+    ''', re.IGNORECASE | re.VERBOSE)
+
+Title = namedtuple('Title', ['season', 'episode', 'last', 'quality', 'airdate'])
+
+
+@lru_cache(maxsize=4096)
+def parse(title):
+    """
+    Get season, episode (and last episode of a multi-episode release),
+    quality and air date of daily shows from a release title.
+    Missing numbers are 0, missing quality is 'na'.
+    """
+    season = episode = last = 0
+    quality = 'na'
+    airdate = None
+    numbered = False
+    for m in TOKENS.finditer(title or ''):
+        if m.group('quality'):
+            if quality == 'na':
+                quality = m.group('quality').lower()
+        elif numbered:
+            continue
+        elif m.group('season'):
+            season, episode = int(m.group('season')), int(m.group('episode'))
+            last = int(m.group('last')) if m.group('last') else episode
+            numbered = True
+        elif m.group('xseason'):
+            season, episode = int(m.group('xseason')), int(m.group('xepisode'))
+            last = int(m.group('xlast')) if m.group('xlast') else episode
+            numbered = True
+        elif m.group('year') and airdate is None:
+            try:
+                airdate = date(int(m.group('year')), int(m.group('month')), int(m.group('day')))
+            except ValueError:
+                log.debug('invalid date %s in %s', m.group(0), title)
+    return Title(season, episode, max(last, episode), quality, airdate)
+
+
+@lru_cache(maxsize=8192)
+def normalize_name(name):
+    """Show name without the characters that are not allowed in paths."""
+    return INVALID_CHARS.sub('', name)
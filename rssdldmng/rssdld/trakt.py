@@ -1,6 +1,11 @@
-import re
+import os
+import json
 import logging
 import time
+from collections import OrderedDict
+from datetime import datetime
+
+from .titleparser import normalize_name
 
 log = logging.getLogger(__name__)
 logging.getLogger("trakt.core").setLevel(logging.WARNING)
@@ -9,6 +14,43 @@ logging.getLogger("trakt.core").setLevel(logging.WARNING)
 # login to trakt first
 # python -c "import trakt; trakt.init(store=True)"
 
+class ShowListCache(object):
+    """
+    Trakt show lists cached in a json file, so that the series filter
+    never has to wait for Trakt
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lists = {}
+        try:
+            with open(self.path) as f:
+                self.lists = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug('no trakt list cache loaded from {0} [{1}]'.format(self.path, e))
+
+    def get(self, name):
+        entry = self.lists.get(name, None)
+        return entry['shows'] if entry else None
+
+    def is_fresh(self, name):
+        entry = self.lists.get(name, None)
+        return entry is not None and time.time() - entry['fetched'] < self.ttl
+
+    def put(self, name, shows):
+        changed = self.get(name) != shows
+        self.lists[name] = {'fetched': int(time.time()), 'shows': shows}
+        try:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wt') as f:
+                json.dump(self.lists, f, indent=4)
+            os.replace(tmp, self.path)
+        except IOError as e:
+            log.warning('cannot save trakt list cache {0} [{1}]'.format(self.path, e))
+        return changed
+
+
 class Trakt():
 
     def __init__(self, config):
@@ -29,6 +71,10 @@ class Trakt():
         self.authenticated = None
         self.cancel = False
 
+        import trakt.core
+        self.lists = ShowListCache(os.path.join(os.path.dirname(trakt.core.CONFIG_PATH), 'trakt_lists.json'),
+                                   config.get('list_ttl', 3600))
+
         try:
             import trakt.users
             trakt.users.User(self.username)
@@ -137,11 +183,24 @@ class Trakt():
 
         return None
 
+    def refreshTvShows(self, list):
+        # fetch list from trakt unless the cached one is still fresh, True if the list changed
+        if self.lists.is_fresh(list):
+            return False
+        shows = self.getTvShows(list)
+        if shows is None:
+            return False
+        return self.lists.put(list, shows)
+
+    def getCachedTvShows(self, list):
+        # last list fetched from trakt, stale or not; None if never fetched
+        return self.lists.get(list)
+
     #@_authenticate
     def getTvShows(self, list):
         if not self.is_authenticated():
             log.warn('Not authenticated to Trakt')
-            return []
+            return None
 
         shows = []
         import trakt.users
@@ -152,44 +211,47 @@ class Trakt():
                 slist = trakt.users.User(self.username).watchlist_shows
             for s in slist:
                 if type(s) is trakt.tv.TVShow:
-                    shows.append(re.sub('[\\/:"*?<>|]+', '', s.title))
+                    shows.append(normalize_name(s.title))
         except trakt.errors.TraktException as te:
-            log.warn('connect to trakt exception [{te}]')
+            log.warn('connect to trakt exception [{0}]'.format(te))
+            shows = None
         except Exception as e:
-            log.warn('cannot get trakt list {list} for user {self.username} [{e}]')
-            shows = []
+            log.warn('cannot get trakt list {0} for user {1} [{2}]'.format(list, self.username, e))
+            shows = None
         return shows
 
     #@_authenticate
-    def setCollected(self, showname, season, episode):
-        if not self.is_authenticated():
-            log.warn('Not authenticated to Trakt')
-            return []
+    def syncEpisodes(self, action, episodes):
+        """
+        Report a batch of (showname, season, episode[, when]) as 'collected' or
+        'watched' in one sync request, when is the unix time of the change (now
+        by default); raises on failure so the caller can retry later
+        """
+        import trakt.core
+        from trakt.utils import slugify
 
-        if not self.report_progress:
-            return True
-        import trakt.users
-        try:
-            ep = trakt.tv.TVEpisode(showname, season, episode)
-            ep.add_to_collection()
-        except (trakt.errors.NotFoundException, Exception) as e:
-            print('WRN: cannot set collected {:s} S{:02d}E{:02d} [{:}]'.format(showname, season, episode, e))
-            return False
-        return True
+        uri = {'collected': 'sync/collection', 'watched': 'sync/history'}[action]
+        now = datetime.utcnow()
+        shows = OrderedDict()
+        for showname, season, episode, *when in episodes:
+            item = {'number': episode}
+            if action == 'watched':
+                watched_at = datetime.utcfromtimestamp(when[0]) if when and when[0] else now
+                item['watched_at'] = watched_at.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            shows.setdefault(showname, OrderedDict()).setdefault(season, []).append(item)
+        payload = {'shows': [{'title': showname,
+                              'ids': {'slug': slugify(showname)},
+                              'seasons': [{'number': season, 'episodes': eps} for season, eps in seasons.items()]}
+                             for showname, seasons in shows.items()]}
 
-    #@_authenticate
-    def setWatched(self, showname, season, episode):
-        if not self.is_authenticated():
-            log.warn('Not authenticated to Trakt')
-            return []
+        @trakt.core.post
+        def sync():
+            result = yield uri, payload
+            yield result
 
-        if not self.report_progress:
-            return True
-        import trakt.users
-        try:
-            ep = trakt.tv.TVEpisode(showname, season, episode)
-            ep.mark_as_seen()
-        except (trakt.errors.NotFoundException, Exception) as e:
-            print('WRN: cannot set watched {:s} S{:02d}E{:02d} [{:}]'.format(showname, season, episode, e))
-            return False
-        return True
+        log.debug('report {0} {1} episodes to trakt'.format(len(episodes), action))
+        response = sync() or {}
+        missing = response.get('not_found', {}).get('shows', [])
+        if missing:
+            log.warn('trakt cannot find shows: {0}'.format(', '.join(str(s.get('title')) for s in missing)))
+        return response
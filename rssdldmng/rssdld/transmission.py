@@ -1,4 +1,7 @@
 import logging
+import threading
+import time
+from collections import OrderedDict
 from enum import Enum
 
 from ..transmission import Transmission as TC
@@ -8,6 +11,11 @@ log = logging.getLogger(__name__)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 log.setLevel(logging.WARNING)
 
+FIELDS = ['id', 'name', 'status', 'hashString', 'eta', 'rateDownload', 'leftUntilDone', 'totalSize']
+# transmission reports torrents (and removed ids) active in the last 60s as recently-active;
+# a poll any later than that would miss changes, keep a margin for the rpc latency
+RECENTLY_ACTIVE_WINDOW = 55
+
 
 class TStatus(Enum):
     STOPPED = 0         # Torrent is stopped
@@ -22,6 +30,7 @@ class TStatus(Enum):
 
 class Torrent(object):
     def __init__(self, map):
+        self.id = map.get('id', None)
         self.name = map['name']
         self.hash = map['hashString']
         self.status = map['status']
@@ -34,6 +43,9 @@ class Torrent(object):
         else:
             self.progress = 0.0
 
+    def serialize(self):
+        return dict(self.__dict__)
+
     def __str__(self):
         if self.hash is not None:
             return "{:<32s} {:2d} {:8d} {:%4.2f}% {:8d}".format(
@@ -42,23 +54,171 @@ class Torrent(object):
             return "None type"
 
 
+class TorrentSnapshot(object):
+    """
+    All torrents known to transmission at one point in time, indexed by hash.
+    changed holds the hashes of the torrents updated or removed by the poll
+    that produced it, full tells that all torrents were read.
+    """
+    def __init__(self, torrents=None, changed=None, full=True):
+        self.torrents = {}
+        for t in torrents or []:
+            self.torrents[t.hash.lower()] = t
+        self.changed = set(self.torrents) if changed is None else changed
+        self.full = full
+
+    def get(self, hash):
+        if not hash:
+            return None
+        return self.torrents.get(hash.lower(), None)
+
+    def __contains__(self, hash):
+        return self.get(hash) is not None
+
+    def __len__(self):
+        return len(self.torrents)
+
+
+class CommandBuffer(object):
+    """
+    Torrent mutations collected during a progress cycle and sent by flush()
+    as one torrent-start/stop/remove RPC each (adds still go one by one).
+    Only the last start/stop/remove of a hash is kept, a remove wins over
+    both, and starts of running / stops of stopped / anything on unknown
+    torrents (as seen in the snapshot) are dropped.
+    Each mutation can carry a callback(ok) run after the flush.
+    """
+
+    METHODS = ('stop', 'start', 'remove')
+
+    def __init__(self, tc, snapshot=None):
+        self.tc = tc
+        self.snapshot = snapshot
+        self.adds = OrderedDict()       # hash or magnet -> (magnet, download_dir, [callbacks])
+        self.actions = OrderedDict()    # lower case hash -> (method, [callbacks])
+        self.dropped = 0
+
+    def _status(self, hash):
+        t = self.snapshot.get(hash) if self.snapshot is not None else None
+        return t.status if t is not None else None
+
+    def add(self, magnet, download_dir, hash=None, callback=None):
+        key = hash.lower() if hash else magnet
+        if key in self.adds:
+            self.dropped += 1
+            magnet, download_dir, callbacks = self.adds[key]
+        else:
+            callbacks = []
+            self.adds[key] = (magnet, download_dir, callbacks)
+        if callback:
+            callbacks.append(callback)
+
+    def _queue(self, method, hash, callback):
+        hash = hash.lower()
+        previous, callbacks = self.actions.pop(hash, (None, []))
+        if previous is not None:
+            self.dropped += 1
+        if previous == 'remove':
+            method = 'remove'
+        if callback:
+            callbacks.append(callback)
+        self.actions[hash] = (method, callbacks)
+
+    def start(self, hash, callback=None):
+        self._queue('start', hash, callback)
+
+    def stop(self, hash, callback=None):
+        self._queue('stop', hash, callback)
+
+    def remove(self, hash, callback=None):
+        self._queue('remove', hash, callback)
+
+    def pending(self):
+        # {method: [hashes]} that flush() would send
+        pending = dict((method, []) for method in self.METHODS)
+        for hash, (method, callbacks) in self.actions.items():
+            status = self._status(hash)
+            if status is None and self.snapshot is not None:
+                # not in transmission, nothing to start, stop or remove
+                continue
+            if method == 'start' and status is not None and status != TStatus.STOPPED.value:
+                continue
+            if method == 'stop' and status == TStatus.STOPPED.value:
+                continue
+            pending[method].append(hash)
+        return pending
+
+    def flush(self):
+        """
+        Send the buffered mutations, run the callbacks and return {hash or magnet: ok}.
+        """
+        results = {}
+        for key, (magnet, download_dir, callbacks) in self.adds.items():
+            ok, rsp = self.tc.call('torrent-add', filename=magnet, download_dir=download_dir, paused=False)
+            results[key] = ok and rsp is not None and ('torrent-added' in rsp or 'torrent-duplicate' in rsp)
+        pending = self.pending()
+        for method in self.METHODS:
+            if pending[method]:
+                ok, rsp = self.tc.call('torrent-' + method, ids=pending[method])
+                results.update((hash, ok) for hash in pending[method])
+        if self.dropped or len(self.actions) > sum(len(h) for h in pending.values()):
+            log.debug('coalesced torrent commands: %d redundant', self.dropped + len(self.actions) -
+                      sum(len(h) for h in pending.values()))
+
+        for key, (magnet, download_dir, callbacks) in self.adds.items():
+            for callback in callbacks:
+                callback(results[key])
+        for hash, (method, callbacks) in self.actions.items():
+            # a dropped no-op counts as done
+            for callback in callbacks:
+                callback(results.get(hash, True))
+        self.adds.clear()
+        self.actions.clear()
+        self.dropped = 0
+        return results
+
+
 class Transmission(object):
-    def __init__(self, config):
-        self.tc = TC(host=config['host'], port=config['port'],
-                     username=config['username'], password=config['password'], timeout=5.0)
+    def __init__(self, config, client=None):
+        # client: rpc callable to use instead of connecting to config's host
+        if client is None:
+            client = TC(host=config['host'], port=config['port'],
+                        username=config['username'], password=config['password'],
+                        timeout=config.get('timeout', 5.0), retries=config.get('retries', 3))
+        self.tc = client
         self.tc('session-stats')
+        # local torrent table, kept up to date from recently-active deltas
+        self.full_resync_interval = config.get('full_resync_interval', 600)
+        self.lock = threading.Lock()
+        self.torrents = {}      # transmission id -> Torrent
+        self.last_poll = 0
+        self.last_full = 0
 
-    def tcrpc(self, method, **kwargs):
+    def close(self):
+        self.tc.close()
+
+    def stats(self):
+        # per rpc method call counts and latency
+        return self.tc.stats()
+
+    def call(self, method, **kwargs):
+        # (ok, response): successful rpcs may have no response arguments
         try:
-            return self.tc(method, **kwargs)
+            return True, self.tc(method, **kwargs)
         except Exception as e:
             log.error("error while executing transmission command {0}".format(e))
-            return None
+            return False, None
+
+    def tcrpc(self, method, **kwargs):
+        return self.call(method, **kwargs)[1]
+
+    def commands(self, snapshot=None):
+        # buffer for the mutations of one progress cycle, see CommandBuffer
+        return CommandBuffer(self, snapshot)
 
     def get(self, hash):
         log.debug('get %s', hash)
-        rsp = self.tcrpc('torrent-get', ids=hash,
-                         fields=['name', 'status', 'hashString', 'eta', 'rateDownload', 'leftUntilDone', 'totalSize'])
+        rsp = self.tcrpc('torrent-get', ids=hash, fields=FIELDS)
         try:
             if rsp and rsp['torrents']:
                 log.debug(rsp)
@@ -67,6 +227,51 @@ class Transmission(object):
             pass
         return None
 
+    def snapshot(self):
+        """
+        All torrents, None if transmission could not be queried. Only torrents
+        changed since the last poll are fetched, unless the last poll is older
+        than the recently-active window or a full resync is due.
+        """
+        with self.lock:
+            now = time.time()
+            full = now - self.last_full >= self.full_resync_interval or now - self.last_poll > RECENTLY_ACTIVE_WINDOW
+            if full:
+                log.debug('get all')
+                rsp = self.tcrpc('torrent-get', fields=FIELDS)
+            else:
+                log.debug('get recently active')
+                rsp = self.tcrpc('torrent-get', ids='recently-active', fields=FIELDS)
+            try:
+                if rsp is None:
+                    return None
+                torrents = [Torrent(t) for t in rsp['torrents']]
+            except KeyError:
+                return None
+
+            previous = dict(self.torrents)
+            if full:
+                self.torrents = {}
+                self.last_full = now
+            for tid in rsp.get('removed', []):
+                self.torrents.pop(tid, None)
+            for t in torrents:
+                self.torrents[t.id] = t
+            self.last_poll = now
+            # updated torrents and the ones gone since the last poll
+            changed = set(t.hash.lower() for t in torrents)
+            changed.update(t.hash.lower() for tid, t in previous.items() if tid not in self.torrents)
+            return TorrentSnapshot(self.torrents.values(), changed, full)
+
+    def lastSnapshot(self):
+        """
+        The torrents as of the last snapshot(), without polling. Readers outside
+        the progress cycle use this: a poll would consume the recently-active
+        delta the cycle relies on.
+        """
+        with self.lock:
+            return TorrentSnapshot(self.torrents.values(), set(), False)
+
     def add(self, magnet, download_dir):
         log.debug('add torrent %s in %s', magnet, download_dir)
         rsp = self.tcrpc('torrent-add', filename=magnet, download_dir=download_dir, paused=False)
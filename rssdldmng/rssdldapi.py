@@ -1,12 +1,18 @@
 import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from urllib.parse import unquote_plus
 
+from rssdldmng.rssdld.episode import FIELDS, PRIVATE_FIELDS
 from rssdldmng.utils.restserver import RESTHttpServer
 
 _LOGGER = logging.getLogger(__name__)
 
+DB_PAGE_SIZE = 100
+DB_MAX_PAGE_SIZE = 1000
+
 
 class ApiServer(RESTHttpServer):
-    def __init__(self, port, mng):
+    def __init__(self, port, mng, backend='threading', max_handlers=16):
         self.routes = {
             r'^/$':                 {'file': '/index.html', 'media_type': 'text/html'},
             r'^\/(?!api\/).*$':     {'file': '/', 'media_type': 'text/html'},
@@ -14,8 +20,10 @@ class ApiServer(RESTHttpServer):
             r'^/api/shows$':        {'GET': self.get_shows, 'media_type': 'application/json'},
             r'^/api/latest$':       {'GET': self.get_latest, 'media_type': 'application/json'},
             r'^/api/status$':       {'GET': self.get_status, 'media_type': 'application/json'},
+            r'^/api/stats$':        {'GET': self.get_stats, 'media_type': 'application/json'},
 
             r'^/api/checkfeed.*$':  {'PUT': self.put_checkfeed, 'media_type': 'application/json'},
+            r'^/api/run/.*$':       {'PUT': self.put_run, 'media_type': 'application/json'},
             r'^/api/db/.*$':        {'GET': self.get_db, 'PUT': self.put_db, 'media_type': 'application/json'},
 
             # r'^/api/setshows$':     {'PUT': self.put_shows, 'media_type': 'application/json'},
@@ -24,7 +32,7 @@ class ApiServer(RESTHttpServer):
         }
         self.manager = mng
         self.servedir = '.'  # os.path.join(self.manager.config['cfgdir'], 'www')
-        RESTHttpServer.__init__(self, '', port, self.routes, self.servedir)
+        RESTHttpServer.__init__(self, '', port, self.routes, self.servedir, backend, max_handlers)
 
     def get_config(self, handler):
         return self.manager.config
@@ -47,7 +55,12 @@ class ApiServer(RESTHttpServer):
         return self.manager.get_latest(21)
 
     def get_status(self, handler):
-        return self.manager.get_status(21)
+        return self.manager.get_status()
+
+    def get_stats(self, handler):
+        if not self.manager.downloader:
+            return 'internal error'
+        return {'episodes': self.manager.downloader.getStats(), 'rpc': self.manager.downloader.getRpcStats()}
 
     def get_traktlist(self, handler):
         args, params = self.get_args(handler.path, 4)
@@ -68,6 +81,18 @@ class ApiServer(RESTHttpServer):
         res = self.manager.downloader.parseFeed(params['feed'])
         return res
 
+    def put_run(self, handler):
+        if not self.manager.downloader:
+            return 'internal error'
+
+        args, params = self.get_args(handler.path, 3)
+        if len(args) < 1 or not args[0]:
+            return 'no job provided'
+
+        if not self.manager.downloader.wake(args[0]):
+            return 'FAIL'
+        return 'OK'
+
     def get_db(self, handler):
         if not self.manager.downloader:
             return 'internal error'
@@ -78,15 +103,62 @@ class ApiServer(RESTHttpServer):
 
         if args[0] == 'dump' or args[0] == 'dumpall':
             state = -1
-            if len(args) >= 2:
+            if len(args) >= 2 and args[1]:
                 state = int(args[1])
+            try:
+                filters = self.get_db_filters(params, state)
+            except ValueError as e:
+                return 'invalid parameter: {0}'.format(e)
+
+            if 'limit' in params or 'after' in params or 'fields' in params:
+                # dump has the fields of cleaned() episodes, dumpall full rows
+                if args[0] == 'dump':
+                    return self.get_db_page(params, filters, [f for f in FIELDS if f not in PRIVATE_FIELDS])
+                return self.get_db_page(params, filters, FIELDS)
+
+            # generators are streamed as json lists
             if args[0] == 'dump':
-                return [e.cleaned() for e in self.manager.downloader.getEpisodes(state=state)]
+                return (e.cleaned() for e in self.manager.downloader.iterEpisodes(**filters))
             else:
-                return self.manager.downloader.getEpisodes(state=state)
+                return self.manager.downloader.iterEpisodes(**filters)
 
         return 'invalid action'
 
+    def get_db_filters(self, params, state=-1):
+        # ?state=&show=&season=&episode=&since= (published after, unix time)
+        return {
+            'state': int(params.get('state', state)),
+            'showname': unquote_plus(params['show']) if 'show' in params else None,
+            'season': int(params.get('season', -1)),
+            'episode': int(params.get('episode', -1)),
+            'published': int(params.get('since', -1)),
+        }
+
+    def get_db_page(self, params, filters, allowed=FIELDS):
+        # ?limit=&after=&fields=a,b,c; returns {'items': [...], 'next': <after value for the next page or None>}
+        try:
+            limit = min(int(params.get('limit', DB_PAGE_SIZE)), DB_MAX_PAGE_SIZE)
+            after = None
+            if 'after' in params:
+                token = params['after'] + '=' * (-len(params['after']) % 4)
+                published, ihash = urlsafe_b64decode(token.encode('ascii')).decode('utf-8').split(':', 1)
+                after = (int(published), ihash)
+        except (ValueError, UnicodeError) as e:
+            return 'invalid parameter: {0}'.format(e)
+        fields = list(allowed)
+        if 'fields' in params:
+            fields = [f for f in unquote_plus(params['fields']).split(',') if f]
+            invalid = [f for f in fields if f not in allowed]
+            if invalid:
+                return 'invalid fields: {0}'.format(', '.join(invalid))
+
+        items, last = self.manager.downloader.getEpisodePage(max(limit, 1), after, fields, **filters)
+        cursor = None
+        if last is not None:
+            # no '=' padding, get_args splits parameters on it
+            cursor = urlsafe_b64encode('{0}:{1}'.format(*last).encode('utf-8')).decode('ascii').rstrip('=')
+        return {'items': items, 'next': cursor}
+
     def put_db(self, handler):
         if not self.manager.downloader:
             return 'internal error'
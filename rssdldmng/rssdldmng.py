@@ -21,6 +21,8 @@ _LOGGER = logging.getLogger(__name__)
 # default config
 def_config = {
     "apiport": API_PORT,
+    "apibackend": "threading",
+    "apimaxhandlers": 16,
     "downloader": {
         "feed_poll_interval": 300,
         "feeds": ["http://showrss.info/other/all.rss"],
@@ -110,7 +112,9 @@ class RSSdldMng:
             self.downloader = Downloader(self.db_file, self.config.get('downloader', None))
             self.downloader.start()
 
-            self.http_server = ApiServer(self.config.get('apiport', API_PORT), self)
+            self.http_server = ApiServer(self.config.get('apiport', API_PORT), self,
+                                         backend=self.config.get('apibackend', 'threading'),
+                                         max_handlers=self.config.get('apimaxhandlers', 16))
             self.http_server.start()
 
             # infinite sleep
@@ -139,25 +143,15 @@ class RSSdldMng:
 
     def get_latest(self, days=7):
         if self.downloader:
-            return self.downloader.getEpisodesFull(published=(int(datetime.now().timestamp()) - 86400 * days))
+            return self.downloader.getLatest(days)
         return []
 
-    def get_status(self, days):
-        new = 0
-        downloading = 0
-        available = 0
+    def get_status(self):
         if self.downloader:
-            for ep in self.downloader.getEpisodesFull(published=(int(datetime.now().timestamp()) - 86400 * days)):
-                if ep.state <= IState.NEW.value:
-                    new += 1
-                elif ep.state < IState.AVAILABLE.value:
-                    downloading += 1
-                else:
-                    if not ep.library:
-                        downloading += 1
-                    elif ep.library.playcount < 1:
-                        available += 1
-            # return "{0} new, {1} downloading, {2} available".format(new, downloading, available)
+            stats = self.downloader.getStats()
+            new = sum(n for state, n in stats.items() if state <= IState.NEW.value)
+            downloading = sum(n for state, n in stats.items() if IState.NEW.value < state < IState.AVAILABLE.value)
+            available = stats.get(IState.AVAILABLE.value, 0)
             return {"new": new, "downloading": downloading, "available": available}
         return "NA"
 
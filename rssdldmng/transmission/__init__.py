@@ -15,11 +15,15 @@ A Python wrapper for Transmission's RPC interface.
 __version__ = '0.7-dev'
 
 import json
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from .json_utils import (TransmissionJSONEncoder, TransmissionJSONDecoder)
 
 CSRF_ERROR_CODE = 409
 UNAUTHORIZED_ERROR_CODE = 401
+RETRY_STATUS_CODES = (502, 503, 504)
 CSRF_HEADER = 'X-Transmission-Session-Id'
 
 
@@ -33,43 +37,106 @@ class Unauthorized(Exception):
 
 class Transmission(object):
     def __init__(self, host='localhost', port=9091, path='/transmission/rpc',
-                 username=None, password=None, ssl=False, timeout=None):
+                 username=None, password=None, ssl=False, timeout=None,
+                 retries=3, backoff=0.5, max_backoff=5.0, pool_size=4):
         """
         Initialize the Transmission client.
 
         The default host, port and path are all set to Transmission's
-        default.
+        default. Requests go through one keep-alive session; connection
+        errors, timeouts and 502/503/504 are retried up to `retries` times
+        with exponential backoff starting at `backoff` seconds.
         """
         self.url = "http://%s:%d%s" % (host, port, path)
         if ssl:
             self.url = "https://%s:%d%s" % (host, port, path)
-        self.headers = {}
         self.tag = 0
         self.timeout = timeout
-
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self._stats = {}
+
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.auth = None
         if username or password:
             self.auth = (username, password)
+            self.session.auth = self.auth
+
+    @property
+    def headers(self):
+        return self.session.headers
 
     def __call__(self, method, **kwargs):
         """
         Send request to Transmission's RPC interface.
         """
-        response = self._make_request(method, **kwargs)
-        return self._deserialize_response(response)
-
-    def _make_request(self, method, **kwargs):
-        body = json.dumps(self._format_request_body(method, **kwargs), cls=TransmissionJSONEncoder)
-        response = requests.post(self.url, data=body, headers=self.headers,
-                                 auth=self.auth, verify=False, timeout=self.timeout)
-        if response.status_code == CSRF_ERROR_CODE:
-            self.headers[CSRF_HEADER] = response.headers[CSRF_HEADER]
-            return self._make_request(method, **kwargs)
-        elif response.status_code == UNAUTHORIZED_ERROR_CODE:
-            raise Unauthorized("Check Username and Password")
-        return response
-
-    def _format_request_body(self, method, **kwargs):
+        with self.lock:
+            tag = self.tag
+            self.tag += 1
+        start = time.time()
+        retries = 0
+        try:
+            response, retries = self._make_request(method, tag, **kwargs)
+            result = self._deserialize_response(response, tag)
+        except Exception:
+            self._account(method, time.time() - start, retries, error=True)
+            raise
+        self._account(method, time.time() - start, retries)
+        return result
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        """
+        Per RPC method: calls, errors, retries, average and max latency in ms.
+        """
+        with self.lock:
+            return dict((method, {'calls': calls, 'errors': errors, 'retries': retries,
+                                  'avg_ms': round(total * 1000 / calls, 1), 'max_ms': round(peak * 1000, 1)})
+                        for method, (calls, errors, retries, total, peak) in self._stats.items())
+
+    def _account(self, method, elapsed, retries, error=False):
+        with self.lock:
+            calls, errors, total_retries, total, peak = self._stats.get(method, (0, 0, 0, 0.0, 0.0))
+            self._stats[method] = (calls + 1, errors + int(error), total_retries + retries,
+                                   total + elapsed, max(peak, elapsed))
+
+    def _make_request(self, method, tag, **kwargs):
+        """
+        Post the request, returns (response, number of retries).
+        """
+        body = json.dumps(self._format_request_body(method, tag, **kwargs), cls=TransmissionJSONEncoder)
+        attempt = 0
+        csrf_refreshed = False
+        while True:
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.status_code == CSRF_ERROR_CODE:
+                    # session id expired (transmission restarted), refresh it once
+                    if csrf_refreshed or CSRF_HEADER not in response.headers:
+                        raise BadRequest("Session id refused (%d)" % response.status_code)
+                    self.session.headers[CSRF_HEADER] = response.headers[CSRF_HEADER]
+                    csrf_refreshed = True
+                    continue
+                elif response.status_code == UNAUTHORIZED_ERROR_CODE:
+                    raise Unauthorized("Check Username and Password")
+                elif response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response, attempt
+            time.sleep(min(self.backoff * (2 ** attempt), self.max_backoff))
+            attempt += 1
+
+    def _format_request_body(self, method, tag, **kwargs):
         """
         Create a request object to be serialized and sent to Transmission.
         """
@@ -78,9 +145,9 @@ class Transmission(object):
         # underscores with them here.
         for k, v in kwargs.items():
             fixed[k.replace('_', '-')] = v
-        return {"method": method, "tag": self.tag, "arguments": fixed}
+        return {"method": method, "tag": tag, "arguments": fixed}
 
-    def _deserialize_response(self, response):
+    def _deserialize_response(self, response, tag):
         """
         Return the response generated by the request object, raising
         BadRequest if there were any problems.
@@ -90,10 +157,8 @@ class Transmission(object):
         if doc['result'] != 'success':
             raise BadRequest("Request failed: '%s'" % doc['result'])
 
-        if doc['tag'] != self.tag:
-            raise BadRequest("Tag mismatch: (got %d, expected %d)" % (doc['tag'], self.tag))
-        else:
-            self.tag += 1
+        if doc['tag'] != tag:
+            raise BadRequest("Tag mismatch: (got %d, expected %d)" % (doc['tag'], tag))
 
         if 'arguments' in doc:
             return doc['arguments'] or None
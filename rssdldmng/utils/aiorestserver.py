@@ -0,0 +1,267 @@
+import asyncio
+import http.client
+import io
+import json
+import logging
+import socket
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from .restserver import chunk, get_file_path, gzipper, json_body, json_chunks
+
+log = logging.getLogger(__name__)
+
+# drop idle keep-alive connections after this many seconds
+IDLE_TIMEOUT = 60
+MAX_HEADERS = 100
+MAX_BODY = 1 << 20
+
+
+class AsyncRequest(object):
+    """
+    What api handlers get instead of a RESTRequestHandler: path, headers
+    and the request payload
+    """
+
+    def __init__(self, command, path, version, headers, body):
+        self.command = command
+        self.path = path
+        self.request_version = version
+        self.headers = headers
+        self.body = body
+
+    def get_payload(self):
+        return json.loads(self.body.decode("utf-8"))
+
+    def keep_alive(self):
+        conn = self.headers.get('Connection', '').lower()
+        if self.request_version == 'HTTP/1.0':
+            return conn == 'keep-alive'
+        return conn != 'close'
+
+
+class AsyncHTTPServer(object):
+    """
+    HTTP/1.1 server on an asyncio loop, with persistent connections.
+    Route handlers are blocking (db, rpc), they run in a pool of at most
+    max_handlers threads; requests above that wait on a semaphore instead
+    of spawning threads.
+    Same interface as ThreadingHTTPServer: serve_forever(), shutdown(),
+    server_address and the routes/router/servedir/static attributes.
+    """
+
+    def __init__(self, server_address, max_handlers=16):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+        self.max_handlers = max_handlers
+        self.routes = None
+        self.router = None
+        self.servedir = None
+        self.static = None
+        self.loop = None
+        self.stopped = None
+        self.connections = set()
+        self.done = threading.Event()
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_handlers)
+        self.semaphore = asyncio.Semaphore(self.max_handlers)
+        self.stopped = asyncio.Event()
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+            self.done.set()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        await self.stopped.wait()
+        server.close()
+        await server.wait_closed()
+        for task in list(self.connections):
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections))
+
+    def shutdown(self):
+        if self.loop is not None and not self.done.is_set():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.done.wait()
+        self.socket.close()
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        # responses are written as head + body, do not let nagle hold back the body
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                request = await asyncio.wait_for(self.read_request(reader), IDLE_TIMEOUT)
+                if request is None:
+                    break
+                keep_alive = request.keep_alive()
+                keep_alive = await self.handle_request(request, writer, keep_alive) and keep_alive
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.error('http connection error [{0}]'.format(e))
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            command, path, version = line.decode('iso-8859-1').split()
+        except ValueError:
+            raise ConnectionError('bad request line {0!r}'.format(line))
+        lines = []
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+            lines.append(header)
+            if len(lines) > MAX_HEADERS:
+                raise ConnectionError('too many headers')
+        headers = http.client.parse_headers(io.BytesIO(b''.join(lines) + b'\r\n'))
+        length = int(headers.get('Content-Length', 0))
+        if length > MAX_BODY:
+            raise ConnectionError('request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return AsyncRequest(command, path, version, headers, body)
+
+    def write_head(self, writer, code, headers, keep_alive):
+        lines = ['HTTP/1.1 {0} {1}'.format(code, HTTPStatus(code).phrase)]
+        lines.extend('{0}: {1}'.format(k, v) for k, v in headers)
+        lines.append('Access-Control-Allow-Origin: *')
+        if not keep_alive:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1'))
+
+    async def send(self, writer, code, headers, body, keep_alive):
+        self.write_head(writer, code, list(headers) + [('Content-Length', len(body))], keep_alive)
+        writer.write(body)
+        await writer.drain()
+        return True
+
+    async def send_text(self, writer, code, text, keep_alive):
+        return await self.send(writer, code, [], text.encode('utf-8'), keep_alive)
+
+    async def handle_request(self, request, writer, keep_alive):
+        # returns False if the connection cannot be reused
+        route = self.router.match(request.path) if self.router else None
+        if route is None:
+            return await self.send_text(writer, 404, 'Route not found\n', keep_alive)
+        if 'file' in route:
+            if request.command not in ('GET', 'HEAD'):
+                return await self.send_text(writer, 405, 'Only GET is supported\n', keep_alive)
+            return await self.handle_file(request, route, writer, keep_alive)
+        if request.command not in route:
+            return await self.send_text(writer, 405, '{0} is not supported for {1}\n'.format(
+                request.command, request.path), keep_alive)
+        async with self.semaphore:
+            return await self.handle_api(request, route, writer, keep_alive)
+
+    async def handle_file(self, request, route, writer, keep_alive):
+        code, headers, entry, body = self.static.respond(
+            get_file_path(route, request.path), request.headers, route.get('media_type'))
+        if code == 404:
+            return await self.send(writer, 404, [], body, keep_alive)
+        self.write_head(writer, code, headers, keep_alive)
+        if code == 200 and request.command == 'GET':
+            if body is not None:
+                writer.write(body)
+            else:
+                # large files go out with os.sendfile where the platform has it
+                await writer.drain()
+                with open(entry.path, 'rb') as f:
+                    await self.loop.sendfile(writer.transport, f, 0, entry.size)
+        await writer.drain()
+        return True
+
+    async def handle_api(self, request, route, writer, keep_alive):
+        gzip = gzipper(request.headers)
+
+        def call():
+            content = route[request.command](request)
+            if content is None or request.command == 'DELETE' or isinstance(content, types.GeneratorType):
+                return content, None
+            return content, json_body(content, gzip)
+
+        content, encoded = await self.loop.run_in_executor(self.executor, call)
+        if content is None:
+            return await self.send_text(writer, 404, 'Not found\n', keep_alive)
+        if request.command == 'DELETE':
+            return await self.send(writer, 200, [], b'', keep_alive)
+
+        headers = [('Content-type', route['media_type'])] if 'media_type' in route else []
+        if encoded is not None:
+            body, gzipped = encoded
+            if gzipped:
+                headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Vary', 'Accept-Encoding'))
+            return await self.send(writer, 200, headers, body, keep_alive)
+
+        # generators are encoded by one pool thread (db cursors stay on it),
+        # the queue bounds how far encoding runs ahead of the socket
+        if gzip:
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Vary', 'Accept-Encoding'))
+        # http/1.0 clients get the body delimited by closing the connection
+        chunked = request.request_version != 'HTTP/1.0'
+        if chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        self.write_head(writer, 200, headers, keep_alive and chunked)
+        queue = asyncio.Queue(4)
+        cancelled = threading.Event()
+
+        def produce():
+            try:
+                for data in json_chunks(content, gzip):
+                    if cancelled.is_set():
+                        return
+                    if data:
+                        asyncio.run_coroutine_threadsafe(queue.put(data), self.loop).result()
+            except Exception as e:
+                log.error('cannot stream response for {0} [{1}]'.format(request.path, e))
+                asyncio.run_coroutine_threadsafe(queue.put(e), self.loop).result()
+            else:
+                asyncio.run_coroutine_threadsafe(queue.put(None), self.loop).result()
+
+        producer = self.loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    if chunked:
+                        writer.write(chunk(b''))
+                    await writer.drain()
+                    return chunked
+                if isinstance(data, Exception):
+                    # headers are gone already, dropping the connection is all that is left
+                    return False
+                writer.write(chunk(data) if chunked else data)
+                await writer.drain()
+        finally:
+            # stop and unblock the producer if the client went away
+            cancelled.set()
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
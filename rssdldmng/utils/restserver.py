@@ -1,20 +1,120 @@
 import os
 import re
-import shutil
 import json
 import threading
 import logging
+import types
+import zlib
 from http.server import BaseHTTPRequestHandler, HTTPServer  # , ThreadingHTTPServer
 from socketserver import ThreadingMixIn
 
+from .staticcache import StaticCache
+
 log = logging.getLogger(__name__)
 
 www = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../www')
 
 
+def serialize(obj):
+    # json fallback for the objects returned by api handlers
+    if hasattr(obj, 'serialize'):
+        return obj.serialize()
+    return obj.__dict__
+
+
+# one encoder for all responses: Episode, Torrent, Video, ... go through serialize()
+encoder = json.JSONEncoder(default=serialize)
+
+# bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+# larger request bodies are not read, the connection is closed instead
+MAX_BODY = 1 << 20
+# streamed responses are written in chunks of about this size
+CHUNK_SIZE = 65536
+
+
+def iterencode(content):
+    # encode a generator as a json list one item at a time, anything else in one go
+    if isinstance(content, types.GeneratorType):
+        yield '['
+        first = True
+        for item in content:
+            if not first:
+                yield ','
+            first = False
+            yield from encoder.iterencode(item)
+        yield ']'
+    else:
+        yield encoder.encode(content)
+
+
+def gzipper(headers):
+    # gzip compressor if the client accepts it, None otherwise
+    if 'gzip' in headers.get('Accept-Encoding', ''):
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    return None
+
+
+def json_body(content, gzip=None):
+    # (body, gzipped) for a response sent in one piece
+    body = encoder.encode(content).encode('utf-8')
+    if gzip and len(body) >= GZIP_MIN_SIZE:
+        return gzip.compress(body) + gzip.flush(), True
+    return body, False
+
+
+def json_chunks(content, gzip=None):
+    # body of a streamed response in pieces of about CHUNK_SIZE, compressed if gzip is given
+    buf = []
+    size = 0
+    for part in iterencode(content):
+        buf.append(part)
+        size += len(part)
+        if size >= CHUNK_SIZE:
+            data = ''.join(buf).encode('utf-8')
+            yield gzip.compress(data) if gzip else data
+            buf = []
+            size = 0
+    data = ''.join(buf).encode('utf-8')
+    yield gzip.compress(data) + gzip.flush() if gzip else data
+
+
+def chunk(data):
+    # http/1.1 chunked transfer encoding frame, empty data ends the body
+    return '{0:X}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n'
+
+
+def get_file_path(route, path):
+    # file name under www: the route's own file, or the request path for '/'
+    if 'file' not in route:
+        return None
+    # servedir = os.path.join(here, self.server.servedir)
+    #servedir = here + "/../www"
+    if route['file'] == '/':
+        return path
+    return route['file']
+
+
+class Router(object):
+    """
+    Route table compiled once; routes are tried in table order
+    """
+
+    def __init__(self, routes):
+        self.routes = [(re.compile(path), route) for path, route in (routes or {}).items()]
+
+    def match(self, path):
+        for regex, route in self.routes:
+            if regex.match(path):
+                return route
+        return None
+
+
 # exists only in python 3.7
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
     allow_reuse_address = True
+    # idle keep-alive connections must not keep the process alive
+    daemon_threads = True
 
     def shutdown(self):
         self.socket.close()
@@ -22,6 +122,13 @@ class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
 
 
 class RESTRequestHandler(BaseHTTPRequestHandler):
+    # needed for chunked transfer encoding; every response carries a
+    # Content-Length or is chunked, so connections can be kept alive
+    protocol_version = 'HTTP/1.1'
+    # drop idle keep-alive connections
+    timeout = 60
+    # headers and body are separate writes, nagle would delay keep-alive responses
+    disable_nagle_algorithm = True
 
     def do_HEAD(self):
         self.handle_method('HEAD')
@@ -42,9 +149,69 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         BaseHTTPRequestHandler.end_headers(self)
 
+    def send_text(self, code, text):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, content, media_type=None):
+        self.send_response(200)
+        if media_type:
+            self.send_header('Content-type', media_type)
+        gzip = gzipper(self.headers)
+        if not isinstance(content, types.GeneratorType):
+            body, gzipped = json_body(content, gzip)
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # stream large lists straight from the db cursor in chunks; http/1.0
+        # clients get the body delimited by closing the connection instead
+        chunked = self.request_version != 'HTTP/1.0'
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        try:
+            for data in json_chunks(content, gzip):
+                if data:
+                    self.wfile.write(chunk(data) if chunked else data)
+            if chunked:
+                self.wfile.write(chunk(b''))
+        except Exception as e:
+            # headers are gone already, dropping the connection is all that is left
+            log.error('cannot stream response for {0} [{1}]'.format(self.path, e))
+            self.close_connection = True
+
+    def read_body(self):
+        # the whole body is read before dispatch, whether the handler uses it or not,
+        # so that it does not end up in front of the next request of the connection
+        if 'Transfer-Encoding' in self.headers:
+            # chunked request bodies are not supported, do not reuse the connection
+            self.close_connection = True
+            return b''
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_BODY:
+            self.close_connection = True
+            return None
+        return self.rfile.read(length) if length else b''
+
     def get_payload(self):
-        payload_len = int(self.headers.get('content-length', 0))
-        payload = self.rfile.read(payload_len)
+        payload = self.body
         if type(payload) is str:
             payload = json.loads(payload)
         elif type(payload) is bytes:
@@ -52,57 +219,53 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
         return payload
 
     def handle_file(self, method, route):
-        if method == 'GET':
-            try:
-                log.debug('xhandle file: {0}'.format(self.get_file_path(route)))
-                f = open(self.get_file_path(route), "rb")
-                try:
-                    self.send_response(200)
-                    if 'media_type' in route:
-                        self.send_header('Content-type', route['media_type'])
-                    self.end_headers()
-                    shutil.copyfileobj(f, self.wfile)
-                finally:
-                    f.close()
-            except Exception as e:
-                log.debug('exception  : {0}'.format(e))
-                #raise e
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write('File not found\n'.encode('utf-8'))
-        else:
-            self.send_response(405)
-            self.end_headers()
-            self.wfile.write('Only GET is supported\n'.encode('utf-8'))
+        if method not in ('GET', 'HEAD'):
+            self.send_text(405, 'Only GET is supported\n')
+            return
+        log.debug('xhandle file: {0}'.format(self.get_file_path(route)))
+        code, headers, entry, body = self.server.static.respond(
+            self.get_file_path(route), self.headers, route.get('media_type'))
+        if code == 404:
+            self.send_text(404, body.decode('utf-8'))
+            return
+        self.send_response(code)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if code != 200 or method == 'HEAD':
+            return
+        if body is not None:
+            self.wfile.write(body)
+            return
+        # large files go straight from the page cache to the socket; socket.sendfile
+        # waits for slow readers within the socket timeout, raw os.sendfile would
+        # fail with EAGAIN on the timeout (non-blocking) socket
+        with open(entry.path, 'rb') as f:
+            self.connection.sendfile(f, 0, entry.size)
 
     def handle_api(self, method, route):
         if method in route:
             content = route[method](self)
             if content is not None:
-                self.send_response(200)
-                if 'media_type' in route:
-                    self.send_header('Content-type', route['media_type'])
-                self.end_headers()
                 if method != 'DELETE':
-                    try:
-                        self.wfile.write(json.dumps(content).encode('utf-8'))
-                    except TypeError:
-                        self.wfile.write(json.dumps(content, default=lambda x: x.__dict__).encode('utf-8'))
+                    self.send_json(content, route.get('media_type'))
+                else:
+                    self.send_response(200)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
             else:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write('Not found\n'.encode('utf-8'))
+                self.send_text(404, 'Not found\n')
         else:
-            self.send_response(405)
-            self.end_headers()
-            self.wfile.write('{0} is not supported for {1}\n'.format(method, self.path).encode('utf-8'))
+            self.send_text(405, '{0} is not supported for {1}\n'.format(method, self.path))
 
     def handle_method(self, method):
+        self.body = self.read_body()
+        if self.body is None:
+            self.send_text(413, 'Request body too large\n')
+            return
         route = self.get_route()
         if route is None:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write('Route not found\n'.encode('utf-8'))
+            self.send_text(404, 'Route not found\n')
         else:
             if 'file' in route:
                 self.handle_file(method, route)
@@ -110,32 +273,35 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
                 self.handle_api(method, route)
 
     def get_route(self):
-        if self.server and self.server.routes:
-            for path, route in self.server.routes.items():
-                if re.match(path, self.path):
-                    return route
+        if self.server and self.server.router:
+            return self.server.router.match(self.path)
         return None
 
     def get_file_path(self, route):
-        if 'file' not in route:
-            return None
-        # get file path from self.path
-        # servedir = os.path.join(here, self.server.servedir)
-        #servedir = here + "/../www"
-        if route['file'] == '/':
-            filepath = www + self.path
-        else:
-            filepath = www + route['file']
-        return filepath
+        return get_file_path(route, self.path)
 
 
 class RESTHttpServer():
-    def __init__(self, ip, port, routes=None, servedir=None):
-        log.info('Starting HTTP server on port {0}, root {1}'.format(port, www))
-        self.server = ThreadingHTTPServer((ip, port), RESTRequestHandler)
+    """
+    REST server on a thread per connection ('threading' backend) or on an
+    asyncio loop with a bounded handler pool ('asyncio' backend)
+    """
+
+    def __init__(self, ip, port, routes=None, servedir=None, backend='threading', max_handlers=16):
+        log.info('Starting {0} HTTP server on port {1}, root {2}'.format(backend, port, www))
+        if backend == 'asyncio':
+            from .aiorestserver import AsyncHTTPServer
+            self.server = AsyncHTTPServer((ip, port), max_handlers)
+        elif backend == 'threading':
+            self.server = ThreadingHTTPServer((ip, port), RESTRequestHandler)
+        else:
+            raise ValueError('unknown HTTP server backend {0}'.format(backend))
         log.debug('HTTP server started')
         self.server.routes = routes
+        self.server.router = Router(routes)
         self.server.servedir = servedir
+        self.server.static = StaticCache(www)
+        self.server.static.preload()
 
     def start(self):
         self.server_thread = threading.Thread(target=self.server.serve_forever)
@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.deadline = None
+        self.running = False
+        self.rerun = False      # woken while running: run again once done
+        self.runs = 0
+        self.skipped = 0
+
+
+class Scheduler(object):
+    """
+    Runs periodic jobs in a worker pool. Deadlines are kept in a heap,
+    run_pending() starts the due jobs and tells how long the caller can
+    sleep. A job can be run early with wake(), a job still running when
+    it is due again is skipped; woken while running, it runs once more
+    right after the current run.
+    """
+
+    def __init__(self, notify=None):
+        self.notify = notify
+        self.lock = threading.Lock()
+        self.heap = []
+        self.jobs = {}
+        self.seq = itertools.count()
+        self.pool = None
+
+    def add(self, name, func, interval, delay=0):
+        if interval <= 0:
+            log.debug('job %s disabled', name)
+            return
+        with self.lock:
+            job = Job(name, func, interval)
+            self.jobs[name] = job
+            self.push(job, time.time() + delay)
+        self.wakeup()
+
+    def push(self, job, deadline):
+        # older heap entries of the job become stale and are dropped when popped
+        job.deadline = deadline
+        heapq.heappush(self.heap, (deadline, next(self.seq), job))
+
+    def wake(self, name):
+        with self.lock:
+            job = self.jobs.get(name, None)
+            if job is None:
+                return False
+            if job.running:
+                # the current run may have missed what the wake is about
+                job.rerun = True
+                return True
+            self.push(job, time.time())
+        self.wakeup()
+        return True
+
+    def wakeup(self):
+        if self.notify:
+            self.notify()
+
+    def run_pending(self):
+        # start all due jobs, return seconds until the next deadline (None if there are no jobs)
+        now = time.time()
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=max(1, len(self.jobs)))
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, job = heapq.heappop(self.heap)
+                if deadline != job.deadline:
+                    continue
+                self.push(job, now + job.interval)
+                if job.running:
+                    log.debug('job %s still running, skipped', job.name)
+                    job.skipped += 1
+                    continue
+                job.running = True
+                self.pool.submit(self.run, job)
+            if not self.heap:
+                return None
+            return max(0, self.heap[0][0] - now)
+
+    def run(self, job):
+        try:
+            job.func()
+        except Exception:
+            log.exception('job %s failed', job.name)
+        finally:
+            with self.lock:
+                job.runs += 1
+                job.running = False
+                rerun, job.rerun = job.rerun, False
+                if rerun and self.pool is not None:
+                    self.push(job, time.time())
+            if rerun:
+                self.wakeup()
+
+    def shutdown(self):
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+            self.heap = []
+        if pool:
+            pool.shutdown(wait=True)
@@ -0,0 +1,138 @@
+import email.utils
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+from urllib.parse import unquote
+
+log = logging.getLogger(__name__)
+
+# files up to this size are kept in memory, larger ones go out with sendfile
+MAX_CACHED_SIZE = 256 * 1024
+# smaller bodies are not worth compressing
+GZIP_MIN_SIZE = 1024
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class StaticFile(object):
+    """
+    A file under the static root: metadata, validators and, for small
+    files, the content and its gzip variant
+    """
+
+    def __init__(self, path, media_type):
+        self.path = path
+        stat = os.stat(path)
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.media_type = media_type
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.data = None
+        self.gzip = None
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            if self.size <= MAX_CACHED_SIZE:
+                self.data = f.read()
+                digest.update(self.data)
+            else:
+                for block in iter(lambda: f.read(65536), b''):
+                    digest.update(block)
+        self.etag = '"{0}"'.format(digest.hexdigest())
+        # strong etags differ per representation
+        self.gzip_etag = '"{0}-gz"'.format(digest.hexdigest())
+
+        if self.data is not None and self.size >= GZIP_MIN_SIZE and media_type.startswith(COMPRESSIBLE):
+            compressed = gzip.compress(self.data, 9)
+            if len(compressed) < self.size:
+                self.gzip = compressed
+
+    def changed(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return stat.st_mtime != self.mtime or stat.st_size != self.size
+
+    def not_modified(self, headers):
+        inm = headers.get('If-None-Match')
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(',')]
+            return '*' in tags or self.etag in tags or self.gzip_etag in tags
+        ims = headers.get('If-Modified-Since')
+        if ims is not None:
+            try:
+                return int(self.mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class StaticCache(object):
+    """
+    Static files served from memory. Files are loaded on first access (or
+    by preload at startup) and reloaded when they change on disk
+    """
+
+    def __init__(self, root, max_age=300):
+        self.root = os.path.realpath(root)
+        self.max_age = max_age
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def preload(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                self.get(os.path.relpath(os.path.join(dirpath, name), self.root))
+        log.debug('static cache: {0} files from {1}'.format(len(self.files), self.root))
+
+    def resolve(self, name):
+        # absolute path of a request path under root, None if it points outside
+        name = unquote(name.split('?')[0].split('#')[0]).lstrip('/')
+        path = os.path.realpath(os.path.join(self.root, name))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def get(self, name, media_type=None):
+        path = self.resolve(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        entry = self.files.get(path)
+        if entry is None or entry.changed():
+            entry = StaticFile(path, mimetypes.guess_type(path)[0] or media_type or 'application/octet-stream')
+            with self.lock:
+                self.files[path] = entry
+        return entry
+
+    def respond(self, name, headers, media_type=None):
+        """
+        (status, response headers, entry, body) for a GET of name; body is
+        None for large files, which are sent from entry.path
+        """
+        try:
+            entry = self.get(name, media_type)
+        except OSError as e:
+            log.debug('exception  : {0}'.format(e))
+            entry = None
+        if entry is None:
+            return 404, [], None, b'File not found\n'
+
+        use_gzip = entry.gzip is not None and 'gzip' in headers.get('Accept-Encoding', '')
+        cache_control = 'no-cache' if entry.media_type == 'text/html' else 'public, max-age={0}'.format(self.max_age)
+        rsp = [('ETag', entry.gzip_etag if use_gzip else entry.etag),
+               ('Last-Modified', entry.last_modified),
+               ('Cache-Control', cache_control)]
+        if entry.gzip is not None:
+            rsp.append(('Vary', 'Accept-Encoding'))
+        if entry.not_modified(headers):
+            return 304, rsp, entry, b''
+
+        body = entry.gzip if use_gzip else entry.data
+        rsp.append(('Content-type', entry.media_type))
+        if use_gzip:
+            rsp.append(('Content-Encoding', 'gzip'))
+        rsp.append(('Content-Length', str(len(body) if body is not None else entry.size)))
+        return 200, rsp, entry, body
@@ -1,4 +1,3 @@
-import time
 import threading
 from threading import Thread
 
@@ -7,6 +6,7 @@ class ServiceThread(Thread):
 
     def __init__(self, service=None):
         self.__is_stopped = threading.Event()
+        self.__wakeup = threading.Event()
         self.__stop_request = False
 
         self.service = service
@@ -25,13 +25,19 @@ class ServiceThread(Thread):
     def stop(self):
         self.__stop_request = True
         self.serve_stop()
+        self.wakeup()
         self.__is_stopped.wait()
         Thread.join(self)
 
+    def wakeup(self):
+        # interrupt the sleep between two serve() calls
+        self.__wakeup.set()
+
     def serve_starting(self):
         raise NotImplementedError("Please Implement this method")
 
     def serve(self):
+        # returns the seconds to sleep before the next call, None for the default poll interval
         raise NotImplementedError("Please Implement this method")
 
     def serve_stop(self):
@@ -45,8 +51,9 @@ class ServiceThread(Thread):
         self.serve_starting()
         try:
             while not self.__stop_request:
-                self.serve()
-                time.sleep(poll_interval)
+                self.__wakeup.clear()
+                delay = self.serve()
+                self.__wakeup.wait(poll_interval if delay is None else delay)
         finally:
             self.__stop_request = False
             self.__is_stopped.set()
@@ -28,7 +28,7 @@ PROJECT_URLS = {
     'Bug Reports': '{}/issues'.format(GITHUB_URL),
 }
 
-PACKAGES = find_packages(exclude=['tests', 'tests.*'])
+PACKAGES = find_packages(exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*'])
 
 with open('requirements.txt') as f:
     REQUIRES = [line.strip() for line in f if line.strip()]
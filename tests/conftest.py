@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""shared fixtures and helpers of the unit tests"""
+import pytest
+
+from rssdldmng.rssdld.episode import Episode, IState
+from rssdldmng.rssdld.showsdb import ShowsDB
+
+
+def make_episode(i, state=IState.NEW.value, showname='Show'):
+    ep = Episode()
+    ep.title = '{0} S01E{1:02d} 720p'.format(showname, i)
+    ep.published = 1500000000 + i
+    ep.link = 'magnet:{0}'.format(i)
+    ep.showname = showname
+    ep.hash = 'HASH{0:04d}'.format(i)
+    ep.quality = '720p'
+    ep.season = 1
+    ep.episode = i
+    ep.state = state
+    return ep
+
+
+@pytest.fixture
+def db(tmpdir):
+    sdb = ShowsDB(str(tmpdir.join('shows.db')))
+    sdb.open()
+    yield sdb
+    sdb.close()
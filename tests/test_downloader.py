@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.downloader module"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from rssdldmng.rssdld.downloader import Downloader
+from rssdldmng.rssdld.episode import IState
+
+ITEM = '''<item>
+<title>{show} S01E{ep:02d} 720p</title>
+<link>magnet:?xt=urn:btih:{hash}</link>
+<pubDate>Mon, 07 Jan 2019 10:00:00 +0000</pubDate>
+<tv:show_id>{showid}</tv:show_id>
+<tv:show_name>{show}</tv:show_name>
+<tv:episode_id>{ep}</tv:episode_id>
+<tv:info_hash>{hash}</tv:info_hash>
+</item>'''
+
+FEED = '''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:tv="http://showrss.info"><channel><title>showRSS</title>
+{items}
+</channel></rss>'''
+
+
+def make_feed(items):
+    return FEED.format(items='\n'.join(ITEM.format(show=show, showid=100 + i, ep=i, hash='{0:040X}'.format(i))
+                                       for i, show in enumerate(items))).encode('utf-8')
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if 'delay=' in self.path:
+            time.sleep(float(self.path.split('delay=')[1]))
+        if self.server.etag and self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def feedserver():
+    server = FeedServer(('127.0.0.1', 0), FeedHandler)
+    server.requests = []
+    server.etag = None
+    server.content = make_feed(['Show One', 'Show Two', 'Other'])
+    server.url = 'http://127.0.0.1:{0}/feed.rss'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(tmpdir):
+    config = {'feeds': [], 'filters': {'series': ['Show One', 'Show Two'], 'quality': ['720p']},
+              'transmission': None, 'feed_poll_interval': 0, 'poll_interval': 0,
+              'dir': str(tmpdir) + '/{seriesname}/Season{seasonno:02}/'}
+    d = Downloader(str(tmpdir.join('shows.db')), config)
+    d.serve_starting()
+    d.updateFilters()
+    yield d
+    d.serve_stopped()
+
+
+def test_parse_feed(downloader, feedserver):
+    res = downloader.parseFeed(feedserver.url)
+    assert res.startswith('found 3 items: 2 accepted, 1 rejected')
+    assert len(downloader.db.getEpisodes()) == 2
+
+
+def test_parse_feed_not_modified(downloader, feedserver):
+    feedserver.etag = '"v1"'
+    downloader.parseFeed(feedserver.url)
+    res = downloader.parseFeed(feedserver.url)
+    assert feedserver.requests[-1]['If-None-Match'] == '"v1"'
+    assert res == 'feed unchanged, skipped 1 of 2 polls'
+
+
+def test_parse_feed_same_content(downloader, feedserver):
+    downloader.parseFeed(feedserver.url)
+    assert downloader.parseFeed(feedserver.url) == 'feed unchanged, skipped 1 of 2 polls'
+    # filter change forces a full fetch and parse
+    downloader.fconfig['series'].append('Other')
+    downloader.updateFilters()
+    assert downloader.parseFeed(feedserver.url).startswith('found 3 items: 1 accepted, 0 rejected')
+
+
+def test_check_feeds_concurrently(downloader, feedserver):
+    downloader.feeds = [feedserver.url + '?{0}&delay=0.5'.format(i) for i in range(6)]
+    start = time.time()
+    downloader.checkFeeds()
+    assert time.time() - start < 1.5
+    assert len(feedserver.requests) == 6
+    assert len(downloader.db.getEpisodes()) == 2
+    assert len(downloader.feedstats) == 6
+
+
+def test_check_feeds_timeout(downloader, feedserver):
+    downloader.feed_timeout = (1, 0.5)
+    downloader.feeds = [feedserver.url + '?delay=3', feedserver.url]
+    start = time.time()
+    downloader.checkFeeds()
+    assert time.time() - start < 2.5
+    assert len(downloader.db.getEpisodes()) == 2
+
+
+def test_latest_snapshot(downloader, feedserver):
+    downloader.latest_days = 100000
+    downloader.parseFeed(feedserver.url)
+    assert downloader.getLatest(100000) == []
+    downloader.checkProgress()
+    latest = downloader.getLatest(100000)
+    assert sorted(ep.showname for ep in latest) == ['Show One', 'Show Two']
+    assert downloader.getLatest(1) == []
+    # later db changes only show up after the next progress cycle
+    downloader.updateEpisode(latest[0].hash, IState.WATCHED.value)
+    assert downloader.getLatest(100000)[0].state == latest[0].state
+    downloader.checkProgress()
+    assert IState.WATCHED.value in [ep.state for ep in downloader.getLatest(100000)]
+
+
+def test_failed_ingest_refetches_feed(downloader, feedserver, monkeypatch):
+    feedserver.etag = '"v1"'
+
+    def locked(items):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(downloader.db, 'addEpisodes', locked)
+    with pytest.raises(RuntimeError):
+        downloader.parseFeed(feedserver.url)
+    monkeypatch.undo()
+    # the feed state was not stored, the items are fetched and added again
+    assert downloader.parseFeed(feedserver.url).startswith('found 3 items: 2 accepted')
+    assert 'If-None-Match' not in feedserver.requests[-1]
+    assert len(downloader.db.getEpisodes()) == 2
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.kodidb module"""
+import json
+import socket
+import time
+
+import pytest
+
+from rssdldmng.rssdld.kodidb import KodiDB, KodiListener
+
+
+def episode(episodeid, tvshowid, season, number, dateadded='2019-01-01 10:00:00', playcount=0, lastplayed=''):
+    return {'episodeid': episodeid, 'showtitle': 'Show', 'title': 'Ep', 'tvshowid': tvshowid, 'season': season,
+            'episode': number, 'file': '/media/show/{0}x{1}.mkv'.format(season, number), 'dateadded': dateadded,
+            'art': {}, 'fanart': '', 'thumbnail': '', 'runtime': 0, 'playcount': playcount,
+            'lastplayed': lastplayed, 'resume': {}}
+
+
+class FakeLibrary(object):
+    def __init__(self):
+        self.shows = [{'tvshowid': 1, 'label': 'Show: Name (2018)'}]
+        self.episodes = [episode(1, 1, 1, 1), episode(2, 1, 1, 2)]
+        self.calls = []
+
+    def GetTVShows(self, **kwargs):
+        self.calls.append(('GetTVShows', kwargs))
+        return {'result': {'tvshows': self.shows}}
+
+    def GetEpisodes(self, **kwargs):
+        self.calls.append(('GetEpisodes', kwargs))
+        return {'result': {'episodes': self.episodes}}
+
+    def GetEpisodeDetails(self, **kwargs):
+        self.calls.append(('GetEpisodeDetails', kwargs))
+        for e in self.episodes:
+            if e['episodeid'] == kwargs['episodeid']:
+                return {'result': {'episodedetails': e}}
+        return {'error': {'code': -32602}}
+
+    def Scan(self, **kwargs):
+        self.calls.append(('Scan', kwargs))
+        self.scanning = True
+        return {'result': 'OK'}
+
+
+class FakeXBMC(object):
+    def __init__(self, library):
+        self.library = library
+
+    def GetInfoBooleans(self, booleans):
+        return {'result': {'Library.IsScanningVideo': self.library.scanning}}
+
+
+class FakeKodi(object):
+    def __init__(self):
+        self.VideoLibrary = FakeLibrary()
+        self.VideoLibrary.scanning = False
+        self.XBMC = FakeXBMC(self.VideoLibrary)
+
+
+@pytest.fixture
+def make_kodidb(monkeypatch):
+    monkeypatch.setattr('rssdldmng.rssdld.kodidb.Kodi', lambda **kwargs: FakeKodi())
+
+    def make(library_root=None, **config):
+        return KodiDB(dict({'host': 'localhost', 'port': 8080, 'username': 'u', 'password': 'p'}, **config), library_root)
+    return make
+
+
+def test_index_lookup_constant_rpcs(make_kodidb):
+    kd = make_kodidb()
+    assert kd.refresh()
+    calls = kd.kd.VideoLibrary.calls
+    assert [c[0] for c in calls] == ['GetTVShows', 'GetEpisodes']
+    assert kd.getVideo('Show Name', 1, 2).episodeid == 2
+    assert kd.getVideo('show name', 1, 3) is None
+    assert kd.getVideo('Other', 1, 1) is None
+    assert len(calls) == 2
+
+
+def test_incremental_refresh(make_kodidb):
+    kd = make_kodidb()
+    kd.refresh()
+    lib = kd.kd.VideoLibrary
+    lib.episodes = [episode(3, 1, 1, 3, dateadded='2019-01-02 10:00:00'),
+                    episode(2, 1, 1, 2, playcount=1, lastplayed='2019-01-02 11:00:00')]
+    kd.refresh()
+    assert lib.calls[-1][0] == 'GetEpisodes'
+    assert 'filter' in lib.calls[-1][1]
+    assert lib.calls[-1][1]['filter']['or'][0]['value'] == '2018-12-31 10:00:00'
+    assert kd.getVideo('Show Name', 1, 3).episodeid == 3
+    assert kd.getVideo('Show Name', 1, 2).playcount == 1
+    assert kd.getVideo('Show Name', 1, 1).episodeid == 1
+    assert len(lib.calls) == 3
+
+
+def test_scan_coordinator(make_kodidb, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('rssdldmng.rssdld.kodidb.time.time', lambda: now[0])
+    kd = make_kodidb('/media/Series/', scan_cooldown=60, rescan_interval=900)
+    lib = kd.kd.VideoLibrary
+
+    def scans():
+        return [c[1] for c in lib.calls if c[0] == 'Scan']
+
+    for e in range(1, 11):
+        kd.updateLibPath('/media/Series/Show/Season01/')
+    kd.updateLibPath('/media/Series/Show/Season02')
+    assert kd.tickScans() is False
+    assert scans() == [{'directory': '/media/Series/Show/'}]
+
+    # one scan in flight: nothing new starts, covered paths are not queued again
+    assert not kd.updateLibPath('/media/Series/Show/Season01/')
+    assert kd.updateLibPath('/media/Series/Other/Season01/')
+    now[0] += 10
+    assert kd.tickScans() is False
+    assert len(scans()) == 1
+
+    # finished, the next scan waits for the cool-down
+    lib.scanning = False
+    now[0] += 10
+    assert kd.tickScans() is True
+    assert len(scans()) == 1
+    now[0] += 60
+    kd.updateLibPath('/media/Series/Third/Season01/')
+    kd.tickScans()
+    assert scans()[-1] == {'directory': '/media/Series/'}
+
+    # recently scanned directories are not scanned again
+    lib.scanning = False
+    now[0] += 10
+    kd.tickScans()
+    assert not kd.updateLibPath('/media/Series/Show/Season01/')
+    now[0] += 900
+    assert kd.updateLibPath('/media/Series/Show/Season01/')
+
+
+def test_scan_without_root(make_kodidb):
+    kd = make_kodidb()
+    kd.updateLibPath('smb://nas/tv/A/Season01/')
+    kd.updateLibPath('smb://nas/tv/B/Season01/')
+    kd.tickScans()
+    assert kd.kd.VideoLibrary.calls[-1] == ('Scan', {})
+
+
+def wait_for(cond, timeout=5):
+    end = time.time() + timeout
+    while not cond() and time.time() < end:
+        time.sleep(0.01)
+    return cond()
+
+
+def test_listener_notifications():
+    srv = socket.socket()
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(1)
+    received = []
+    states = []
+    listener = KodiListener('127.0.0.1', srv.getsockname()[1], lambda m, d: received.append((m, d)), states.append)
+    listener.start()
+    conn, _ = srv.accept()
+    try:
+        data = (json.dumps({'jsonrpc': '2.0', 'method': 'VideoLibrary.OnUpdate',
+                            'params': {'data': {'item': {'id': 7, 'type': 'episode', 'title': 'Caf\u00e9'}}}},
+                           ensure_ascii=False) +
+                json.dumps({'jsonrpc': '2.0', 'id': 1, 'result': 'OK'}) + '\n' +
+                json.dumps({'jsonrpc': '2.0', 'method': 'VideoLibrary.OnScanFinished', 'params': {'data': None}}))
+        data = data.encode('utf-8')
+        # objects split across packets (here inside a utf-8 character) and glued together
+        split = data.index('\u00e9'.encode('utf-8')) + 1
+        conn.sendall(data[:split])
+        time.sleep(0.05)
+        conn.sendall(data[split:])
+        assert wait_for(lambda: len(received) == 2)
+        assert received[0] == ('VideoLibrary.OnUpdate', {'item': {'id': 7, 'type': 'episode', 'title': 'Caf\u00e9'}})
+        assert received[1] == ('VideoLibrary.OnScanFinished', None)
+        assert states == [True]
+    finally:
+        listener.stop()
+        conn.close()
+        srv.close()
+    listener.join(5)
+    assert not listener.is_alive()
+    assert states == [True, False]
+
+
+def test_notifications_coalesced(make_kodidb):
+    kd = make_kodidb(notify_delay=0.1)
+    woken = []
+    kd.on_change = lambda: woken.append(1)
+    # a scan adding many episodes
+    for i in range(20):
+        kd.onNotification('VideoLibrary.OnUpdate', {'item': {'id': i, 'type': 'episode'}})
+    assert woken == []
+    assert wait_for(lambda: woken == [1])
+    time.sleep(0.2)
+    assert woken == [1]
+    assert len(kd.changed) == 20
+
+
+def test_refresh_from_notifications(make_kodidb, monkeypatch):
+    kd = make_kodidb(notify_delay=0)
+    woken = []
+    kd.on_change = lambda: woken.append(1)
+    monkeypatch.setattr(kd, 'isListening', lambda: True)
+    kd.refresh()
+    lib = kd.kd.VideoLibrary
+
+    # nothing notified, nothing fetched
+    kd.refresh()
+    assert len(lib.calls) == 2
+
+    lib.episodes[1] = episode(2, 1, 1, 2, playcount=1, lastplayed='2019-01-02 11:00:00')
+    kd.onNotification('VideoLibrary.OnUpdate', {'item': {'id': 2, 'type': 'episode'}, 'playcount': 1})
+    kd.onNotification('VideoLibrary.OnUpdate', {'item': {'id': 5, 'type': 'movie'}})
+    assert woken == [1]
+    kd.refresh()
+    assert lib.calls[2:] == [('GetEpisodeDetails', {'episodeid': 2, 'properties': lib.calls[2][1]['properties']})]
+    assert kd.getVideo('Show Name', 1, 2).playcount == 1
+
+    # a finished scan may have added several episodes, poll for changes
+    kd.onNotification('VideoLibrary.OnScanFinished', None)
+    kd.refresh()
+    assert lib.calls[-1][0] == 'GetEpisodes'
+    assert 'filter' in lib.calls[-1][1]
+
+
+def test_updated_episodes(make_kodidb):
+    kd = make_kodidb()
+    assert kd.takeUpdated() is None
+    kd.refresh()
+    assert kd.takeUpdated() is None
+    assert kd.takeUpdated() == []
+    lib = kd.kd.VideoLibrary
+    lib.episodes = [episode(1, 1, 1, 1), episode(2, 1, 1, 2, playcount=1, lastplayed='2019-01-02 11:00:00'),
+                    episode(3, 1, 1, 3)]
+    kd.refresh()
+    assert sorted(kd.takeUpdated()) == [('show name (2018)', 1, 2), ('show name (2018)', 1, 3)]
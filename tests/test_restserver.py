@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.utils.restserver module"""
+import gzip
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from rssdldmng.rssdld.episode import Episode
+from rssdldmng.utils.restserver import RESTHttpServer, Router
+
+
+def make_episode(i):
+    ep = Episode()
+    ep.title = 'Show S01E{0:02d} 720p'.format(i)
+    ep.showname = 'Show'
+    ep.season = 1
+    ep.episode = i
+    ep.hash = 'HASH{0:04d}'.format(i)
+    return ep
+
+
+@pytest.fixture(params=['threading', 'asyncio'])
+def server(request):
+    routes = {
+        r'^/api/small$': {'GET': lambda h: {'ok': True}, 'media_type': 'application/json'},
+        r'^/api/list$': {'GET': lambda h: (make_episode(i) for i in range(2000)), 'media_type': 'application/json'},
+    }
+    srv = RESTHttpServer('127.0.0.1', 0, routes, backend=request.param)
+    srv.start()
+    yield srv
+    srv.stop()
+
+
+def request(server, path, headers=None, conn=None):
+    conn = conn or http.client.HTTPConnection('127.0.0.1', server.server.server_address[1])
+    conn.request('GET', path, headers=headers or {})
+    rsp = conn.getresponse()
+    return conn, rsp, rsp.read()
+
+
+def test_small_response(server):
+    conn, rsp, body = request(server, '/api/small', {'Accept-Encoding': 'gzip'})
+    assert rsp.getheader('Content-Length') == str(len(body))
+    assert rsp.getheader('Content-Encoding') is None
+    assert json.loads(body.decode('utf-8')) == {'ok': True}
+    # connection is kept alive
+    conn, rsp, body = request(server, '/api/nothing', conn=conn)
+    assert rsp.status == 404
+
+
+def test_streamed_response(server):
+    conn, rsp, body = request(server, '/api/list')
+    assert rsp.getheader('Transfer-Encoding') == 'chunked'
+    episodes = json.loads(body.decode('utf-8'))
+    assert len(episodes) == 2000
+    assert episodes[1]['hash'] == 'HASH0001'
+
+    conn, rsp, body = request(server, '/api/list', {'Accept-Encoding': 'gzip, deflate'}, conn)
+    assert rsp.getheader('Content-Encoding') == 'gzip'
+    assert json.loads(gzip.decompress(body).decode('utf-8')) == episodes
+
+
+def test_router():
+    router = Router({r'^/$': {'file': '/index.html'}, r'^\/(?!api\/).*$': {'file': '/'}, r'^/api/db/.*$': {'GET': None}})
+    assert router.match('/')['file'] == '/index.html'
+    assert router.match('/app.js')['file'] == '/'
+    assert 'GET' in router.match('/api/db/dump')
+    assert router.match('/api/other') is None
+
+
+def test_asyncio_max_handlers():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def slow(handler):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.2)
+        with lock:
+            active.pop()
+        return handler.get_payload()
+
+    srv = RESTHttpServer('127.0.0.1', 0, {r'^/api/slow$': {'PUT': slow}}, backend='asyncio', max_handlers=2)
+    srv.start()
+    results = []
+
+    def client(i):
+        conn = http.client.HTTPConnection('127.0.0.1', srv.server.server_address[1])
+        conn.request('PUT', '/api/slow', body=json.dumps({'i': i}))
+        results.append(json.loads(conn.getresponse().read().decode('utf-8')))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    srv.stop()
+    assert sorted(r['i'] for r in results) == list(range(6))
+    assert max(peak) == 2
+
+
+def test_static_files(server, tmpdir):
+    from rssdldmng.utils.staticcache import MAX_CACHED_SIZE, StaticCache
+    data = os.urandom(MAX_CACHED_SIZE * 2)
+    tmpdir.join('big.bin').write_binary(data)
+    tmpdir.join('index.html').write('<html></html>')
+    server.server.routes = {r'^/$': {'file': '/index.html'}, r'^/.*$': {'file': '/'}}
+    server.server.router = Router(server.server.routes)
+    server.server.static = StaticCache(str(tmpdir))
+
+    conn, rsp, body = request(server, '/')
+    assert body == b'<html></html>'
+    conn, rsp, body = request(server, '/', {'If-None-Match': rsp.getheader('ETag')}, conn)
+    assert rsp.status == 304 and body == b''
+    conn, rsp, body = request(server, '/big.bin', conn=conn)
+    assert body == data
+    conn, rsp, body = request(server, '/../test_restserver.py', conn=conn)
+    assert rsp.status == 404
+
+
+def test_unread_body_keep_alive(server):
+    server.server.router = Router({r'^/api/run$': {'PUT': lambda h: 'ok'},
+                                   r'^/api/small$': {'GET': lambda h: {'ok': True}}})
+    conn = http.client.HTTPConnection('127.0.0.1', server.server.server_address[1])
+    # the handler ignores the body, it must not be taken for the next request
+    conn.request('PUT', '/api/run', body='null')
+    assert conn.getresponse().read() == b'"ok"'
+    conn, rsp, body = request(server, '/api/small', conn=conn)
+    assert rsp.status == 200 and json.loads(body.decode('utf-8')) == {'ok': True}
+
+
+def test_streamed_response_http10(server):
+    sock = socket.create_connection(('127.0.0.1', server.server.server_address[1]))
+    sock.sendall(b'GET /api/list HTTP/1.0\r\n\r\n')
+    data = b''
+    while True:
+        block = sock.recv(65536)
+        if not block:
+            break
+        data += block
+    sock.close()
+    head, body = data.split(b'\r\n\r\n', 1)
+    assert b'Transfer-Encoding' not in head
+    assert len(json.loads(body.decode('utf-8'))) == 2000
+
+
+def test_static_file_slow_reader(server, tmpdir):
+    from rssdldmng.utils.staticcache import StaticCache
+    data = os.urandom(4 << 20)
+    tmpdir.join('big.bin').write_binary(data)
+    server.server.router = Router({r'^/.*$': {'file': '/'}})
+    server.server.static = StaticCache(str(tmpdir))
+
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(('127.0.0.1', server.server.server_address[1]))
+    sock.sendall(b'GET /big.bin HTTP/1.1\r\nConnection: close\r\n\r\n')
+    # let the server run into a full socket buffer before reading
+    time.sleep(0.5)
+    received = b''
+    while True:
+        block = sock.recv(1 << 20)
+        if not block:
+            break
+        received += block
+        if len(received) < 1 << 20:
+            time.sleep(0.01)
+    sock.close()
+    head, body = received.split(b'\r\n\r\n', 1)
+    assert body == data
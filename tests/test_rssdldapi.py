@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdldapi module"""
+import pytest
+
+from rssdldmng.rssdld.episode import Episode
+from rssdldmng.rssdldapi import ApiServer
+
+
+class FakeDownloader(object):
+    def __init__(self, episodes):
+        self.episodes = episodes
+
+    def iterEpisodes(self, **filters):
+        return iter(self.episodes)
+
+    def getEpisodePage(self, limit, after=None, fields=None, **filters):
+        return [dict((f, getattr(ep, f)) for f in fields) for ep in self.episodes[:limit]], None
+
+
+class FakeManager(object):
+    def __init__(self, episodes):
+        self.downloader = FakeDownloader(episodes)
+
+
+class FakeHandler(object):
+    def __init__(self, path):
+        self.path = path
+
+
+@pytest.fixture
+def api():
+    # bound to a free port, handlers are called directly
+    srv = ApiServer(0, FakeManager([]))
+    yield srv
+    srv.server.server_close()
+
+
+def test_db_dump_projection(api):
+    ep = Episode()
+    ep.title = 'Show S01E01 720p'
+    ep.showname = 'Show'
+    ep.hash = 'HASH0001'
+    api.manager.downloader.episodes = [ep]
+
+    streamed = list(api.get_db(FakeHandler('/api/db/dump')))
+    paged = api.get_db(FakeHandler('/api/db/dump?limit=10'))['items']
+    assert set(paged[0]) == set(streamed[0])
+    assert 'hash' not in paged[0]
+    assert api.get_db(FakeHandler('/api/db/dump?fields=title,hash')).startswith('invalid fields: hash')
+    assert api.get_db(FakeHandler('/api/db/dumpall?limit=10'))['items'][0]['hash'] == 'HASH0001'
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.utils.scheduler module"""
+import threading
+import time
+
+from rssdldmng.utils.scheduler import Scheduler
+
+
+def test_run_pending_deadlines():
+    calls = []
+    s = Scheduler()
+    s.add('a', lambda: calls.append('a'), 10)
+    s.add('b', lambda: calls.append('b'), 5, delay=5)
+    s.add('off', lambda: calls.append('off'), 0)
+    delay = s.run_pending()
+    assert 4 < delay <= 5
+    s.shutdown()
+    assert calls == ['a']
+    assert 'off' not in s.jobs
+
+
+def test_wake():
+    woken = []
+    calls = []
+    s = Scheduler(notify=lambda: woken.append(True))
+    s.add('a', lambda: calls.append('a'), 60, delay=60)
+    assert s.run_pending() > 59
+    assert s.wake('a')
+    assert not s.wake('missing')
+    assert len(woken) == 2
+    assert s.run_pending() > 59
+    s.shutdown()
+    assert calls == ['a']
+
+
+def test_overlapping_runs_skipped():
+    release = threading.Event()
+    s = Scheduler()
+    s.add('slow', release.wait, 0.01)
+    s.run_pending()
+    time.sleep(0.05)
+    s.run_pending()
+    job = s.jobs['slow']
+    assert job.running and job.skipped == 1
+    release.set()
+    s.shutdown()
+    assert job.runs == 1 and not job.running
+
+
+def test_wake_while_running_reruns():
+    release = threading.Event()
+    woken = []
+    s = Scheduler(notify=lambda: woken.append(True))
+    s.add('slow', release.wait, 60)
+    s.run_pending()
+    job = s.jobs['slow']
+    assert s.wake('slow') and job.rerun
+    # not started twice, and not pushed back by a full interval
+    assert s.run_pending() > 59
+    release.set()
+    for _ in range(100):
+        if len(woken) == 2:
+            break
+        time.sleep(0.01)
+    assert len(woken) == 2 and not job.running
+    assert s.run_pending() > 59
+    s.shutdown()
+    assert job.runs == 2 and job.skipped == 0
+
+
+def test_failing_job_keeps_running():
+    s = Scheduler()
+    s.add('fail', lambda: 1 / 0, 0.01)
+    s.run_pending()
+    time.sleep(0.05)
+    s.run_pending()
+    s.shutdown()
+    assert s.jobs['fail'].runs == 2
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.series module"""
+from rssdldmng.rssdld.episode import Episode
+from rssdldmng.rssdld.series import SeriesIndex, canonical
+
+
+def make_episode(showname, showid=0):
+    ep = Episode()
+    ep.showname = showname
+    ep.showid = showid
+    return ep
+
+
+def test_canonical():
+    assert canonical("Marvel's Agents of S.H.I.E.L.D.") == canonical('Marvels Agents of S H I E L D')
+    assert canonical('Doctor Who (2005)') == canonical('doctor who')
+    assert canonical('Law & Order: Special Victims Unit') == canonical('Law and Order Special Victims Unit')
+    assert canonical('The Office (US)') != canonical('The Office')
+
+
+def test_match():
+    index = SeriesIndex(["Marvel's Agents of S.H.I.E.L.D.", 'Doctor Who', 'Law & Order'])
+    assert len(index) == 3
+    assert index.match(make_episode('Marvels Agents of S.H.I.E.L.D', 10))
+    assert index.match(make_episode('Doctor Who (2005)', 11))
+    assert index.match(make_episode('Law and Order', 12))
+    assert not index.match(make_episode('Other', 13))
+    # learned showrss ids match renamed shows
+    assert index.match(make_episode('Agents of SHIELD', 10))
+
+
+def test_aliases():
+    index = SeriesIndex(['Shameless (US)'], aliases={'Shameless US': 'Shameless (US)', 'Unknown': 'Not wanted'},
+                        showids=[(5, 'Shameless (US)'), (6, 'Other')])
+    assert index.showids == {5: canonical('Shameless (US)')}
+    assert index.match(make_episode('Shameless US', 7))
+    assert index.match(make_episode('Renamed', 5))
+    assert not index.match(make_episode('Unknown', 8))
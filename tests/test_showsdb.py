@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.showsdb module"""
+import threading
+import time
+
+from rssdldmng.rssdld.episode import Episode, IState
+from rssdldmng.rssdld.showsdb import ShowsDB
+
+from .conftest import make_episode
+
+
+def test_connection_per_thread(db):
+    conns = []
+    ready = threading.Event()
+    done = threading.Event()
+
+    def worker():
+        conns.append(db.connection())
+        ready.set()
+        done.wait()
+
+    t = threading.Thread(target=worker)
+    t.start()
+    ready.wait()
+    assert db.connection() is db.connection()
+    assert conns[0] is not db.connection()
+    assert len(db.conns) == 2
+    # closed when the thread ends
+    done.set()
+    t.join()
+    for _ in range(100):
+        if len(db.conns) == 1:
+            break
+        time.sleep(0.01)
+    assert db.conns == [db.connection()]
+
+
+def test_no_connection_leak(db):
+    for _ in range(50):
+        t = threading.Thread(target=lambda: db.getEpisodes())
+        t.start()
+        t.join()
+    time.sleep(0.05)
+    assert len(db.conns) == 1
+
+
+def test_close_and_reopen(db):
+    db.addEpisode(make_episode(1))
+    db.close()
+    assert db.conns == []
+    db.open()
+    assert db.getEpisode('HASH0001').episode == 1
+
+
+def test_add_update_get(db):
+    assert db.addEpisode(make_episode(1)) is not None
+    assert db.addEpisode(make_episode(1)) is None
+    ep = db.getEpisode('HASH0001')
+    db.updateEpisodeState(ep, IState.DOWNLOADING.value)
+    assert db.getEpisode('HASH0001').state == IState.DOWNLOADING.value
+    assert len(db.getEpisodes(IState.DOWNLOADING.value)) == 1
+    assert db.getEpisode('missing') is None
+
+
+def test_add_episodes_bulk(db):
+    db.addEpisode(make_episode(1))
+    eps = [make_episode(i) for i in range(5)] + [make_episode(3)]
+    added = db.addEpisodes(eps)
+    assert [ep.hash for ep in added] == ['HASH0000', 'HASH0002', 'HASH0003', 'HASH0004']
+    assert len(db.getEpisodes()) == 5
+    assert db.addEpisodes(eps) == []
+    assert db.addEpisodes([]) == []
+
+
+def test_migrate_legacy_db(tmpdir):
+    import sqlite3
+    from rssdldmng.rssdld.showsdb import MIGRATIONS
+    path = str(tmpdir.join('legacy.db'))
+    dbc = sqlite3.connect(path)
+    dbc.execute(MIGRATIONS[0][2][0].replace('IF NOT EXISTS ', ''))
+    dbc.execute("INSERT INTO episodes (hash, state) VALUES ('HASH', 2)")
+    dbc.commit()
+    dbc.close()
+
+    sdb = ShowsDB(path)
+    sdb.open()
+    assert sdb.migrate() == MIGRATIONS[-1][0]
+    dbc = sdb.connection().wrapper.dbc
+    indexes = [row['name'] for row in dbc.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert 'episodes_state' in indexes
+    assert 'episodes_numbering' in indexes
+    plan = dbc.execute('EXPLAIN QUERY PLAN SELECT * FROM episodes WHERE state = 2').fetchall()
+    assert 'episodes_state' in plan[0]['detail']
+    assert sdb.getEpisode('HASH').state == 2
+    sdb.close()
+
+
+def test_episode_rows(db):
+    ep = make_episode(7)
+    db.addEpisode(ep)
+    dbep = db.getEpisode(ep.hash)
+    assert dbep.as_row() == ep.as_row()
+    assert not hasattr(dbep, '__dict__')
+    assert 'torrent' not in dbep.serialize()
+    dbep.torrent = None
+    assert dbep.serialize()['torrent'] is None
+    assert 'hash' not in dbep.cleaned()
+    assert [e.hash for e in db.getEpisodes(showname='Show', season=1, episode=7)] == [ep.hash]
+    # whole db rows (SELECT *) carry more columns than episode fields
+    row = db.connection().where('hash', ep.hash).get('episodes', 1)[0]
+    assert 'next_check_at' in row
+    assert Episode(entries=row).as_row() == ep.as_row()
+
+
+def test_trakt_outbox(db):
+    db.queueTraktUpdate('collected', 'Show', 1, 1)
+    db.queueTraktUpdate('watched', 'Show', 1, 2)
+    updates = db.getTraktUpdates()
+    assert [(u['action'], u['episode']) for u in updates] == [('collected', 1), ('watched', 2)]
+
+    db.deferTraktUpdates([updates[0]['id']], 60, 3600)
+    assert [u['episode'] for u in db.getTraktUpdates()] == [2]
+    db.deleteTraktUpdates([updates[1]['id']])
+    assert db.getTraktUpdates() == []
+
+    db.connection().wrapper.dbc.execute('UPDATE `trakt_outbox` SET `next_attempt` = 0')
+    db.deferTraktUpdates([updates[0]['id']], 60, 3600)
+    row = db.connection().wrapper.dbc.execute('SELECT * FROM `trakt_outbox`').fetchall()[0]
+    assert row['attempts'] == 2
+    assert row['next_attempt'] - row['queued'] >= 120
+
+    # no overflow after many failures, dropped at max_attempts
+    db.connection().wrapper.dbc.execute('UPDATE `trakt_outbox` SET `attempts` = 70')
+    assert db.deferTraktUpdates([updates[0]['id']], 60, 3600, 100) == 0
+    row = db.connection().wrapper.dbc.execute('SELECT * FROM `trakt_outbox`').fetchall()[0]
+    assert row['next_attempt'] - time.time() > 3000
+    assert db.deferTraktUpdates([updates[0]['id']], 60, 3600, 72) == 1
+    assert db.connection().wrapper.dbc.execute('SELECT * FROM `trakt_outbox`').fetchall() == []
+
+
+def test_state_stats(db):
+    db.addEpisodes([make_episode(i) for i in range(1, 4)])
+    db.addEpisode(make_episode(4, IState.WATCHED.value))
+    assert db.getStats() == {IState.NEW.value: 3, IState.WATCHED.value: 1}
+
+    ep = db.getEpisode('HASH0001')
+    db.updateEpisodeState(ep, IState.DOWNLOADING.value)
+    ep.state = IState.AVAILABLE.value
+    db.updateEpisode(ep)
+    db.updateEpisodeState(make_episode(99), IState.DOWNLOADING.value)
+    stats = db.getStats()
+    assert stats[IState.NEW.value] == 2
+    assert stats[IState.DOWNLOADING.value] == 0
+    assert stats[IState.AVAILABLE.value] == 1
+
+    db.loadStats()
+    assert db.getStats() == {IState.NEW.value: 2, IState.AVAILABLE.value: 1, IState.WATCHED.value: 1}
+
+
+def test_episode_pages(db):
+    eps = [make_episode(i, showname='Show' if i % 2 else 'Other') for i in range(1, 26)]
+    for ep in eps[10:15]:
+        ep.published = eps[10].published
+    db.addEpisodes(eps)
+
+    seen = []
+    after = None
+    while True:
+        page, after = db.getEpisodePage(4, after, fields=['hash', 'state'])
+        assert all(set(ep) == {'hash', 'state'} for ep in page)
+        seen.extend(ep['hash'] for ep in page)
+        if after is None:
+            break
+    expected = sorted(eps, key=lambda ep: (ep.published, ep.hash), reverse=True)
+    assert seen == [ep.hash for ep in expected]
+
+    page, after = db.getEpisodePage(100, showname='Other')
+    assert len(page) == 12 and after is None
+    assert page[0]['title'] == 'Other S01E24 720p'
+    assert db.getEpisodePage(5, showname='Show', season=1, episode=3)[0][0]['hash'] == 'HASH0003'
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.statemachine module"""
+from rssdldmng.rssdld.episode import IState
+from rssdldmng.rssdld.statemachine import StateMachine, MANUAL
+
+from .conftest import make_episode
+
+
+def test_only_due_episodes_are_checked(db):
+    sm = StateMachine(db)
+    checked = []
+    sm.handle(IState.AVAILABLE, lambda ep: checked.append(ep.hash))
+    db.addEpisodes([make_episode(i, IState.AVAILABLE.value) for i in range(50)])
+
+    # new rows are due once, then wait for their interval
+    assert sm.run() == 50
+    assert len(checked) == 50
+    assert sm.run() == 0
+
+    # an event makes just the affected episodes due
+    assert sm.markDue(['hash0007', 'HASH0009', 'unknown']) == 2
+    del checked[:]
+    assert sm.run() == 2
+    assert sorted(checked) == ['HASH0007', 'HASH0009']
+
+    assert sm.markStatesDue([IState.AVAILABLE]) == 50
+    assert sm.run() == 50
+
+
+def test_transitions_chain_and_log(db):
+    sm = StateMachine(db, {'downloading': 0})
+    sm.handle(IState.NEW, lambda ep: sm.transition(ep, IState.DOWNLOADING.value))
+    sm.handle(IState.DOWNLOADING, lambda ep: ep.episode == 1 and sm.transition(ep, IState.FINISHED.value))
+    db.addEpisodes([make_episode(1), make_episode(2)])
+
+    assert sm.run() == 2
+    assert db.getEpisode('HASH0001').state == IState.FINISHED.value
+    assert db.getEpisode('HASH0002').state == IState.DOWNLOADING.value
+    log = db.getTransitions('HASH0001')
+    assert [(t['from_state'], t['to_state'], t['cause']) for t in log] == [
+        (IState.NEW.value, IState.DOWNLOADING.value, 'added to transmission'),
+        (IState.DOWNLOADING.value, IState.FINISHED.value, 'download complete')]
+
+    # still downloading, checked every cycle with a 0 interval
+    assert sm.run() == 1
+
+
+def test_invalid_and_manual_transitions(db):
+    sm = StateMachine(db)
+    ep = make_episode(1)
+    db.addEpisode(ep)
+    assert not sm.transition(ep, IState.WATCHED.value)
+    assert db.getEpisode(ep.hash).state == IState.NEW.value
+    assert sm.transition(ep, IState.WATCHED.value, MANUAL)
+    assert db.getTransitions(ep.hash)[-1]['cause'] == MANUAL
+    # final state, never due again
+    assert sm.markDue([ep.hash]) == 0
+    assert db.getDueEpisodes() == []
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.utils.staticcache module"""
+import gzip
+import os
+
+import pytest
+
+from rssdldmng.utils.staticcache import MAX_CACHED_SIZE, StaticCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    tmpdir.join('www').mkdir()
+    tmpdir.join('www', 'index.html').write('<html>{0}</html>'.format('x' * 4096))
+    tmpdir.join('www', 'app.js').write('var a = 1;')
+    tmpdir.join('www', 'big.bin').write_binary(os.urandom(MAX_CACHED_SIZE + 1))
+    tmpdir.join('secret.txt').write('secret')
+    sc = StaticCache(str(tmpdir.join('www')))
+    sc.preload()
+    return sc
+
+
+def test_respond(cache):
+    code, headers, entry, body = cache.respond('/index.html', {})
+    headers = dict(headers)
+    assert code == 200
+    assert body == entry.data
+    assert headers['Content-type'] == 'text/html'
+    assert headers['Cache-Control'] == 'no-cache'
+    assert headers['ETag'] == entry.etag
+
+    code, headers, entry, body = cache.respond('/index.html', {'Accept-Encoding': 'gzip'})
+    headers = dict(headers)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['ETag'] == entry.gzip_etag
+    assert gzip.decompress(body) == entry.data
+
+    # too small to compress
+    code, headers, entry, body = cache.respond('/app.js?v=1', {'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in dict(headers)
+    assert dict(headers)['Content-type'].endswith('javascript')
+
+
+def test_conditional(cache):
+    etag = dict(cache.respond('/index.html', {})[1])['ETag']
+    assert cache.respond('/index.html', {'If-None-Match': etag})[0] == 304
+    assert cache.respond('/index.html', {'If-None-Match': '"other", ' + etag})[0] == 304
+    assert cache.respond('/index.html', {'If-None-Match': '"other"'})[0] == 200
+    modified = dict(cache.respond('/index.html', {})[1])['Last-Modified']
+    assert cache.respond('/index.html', {'If-Modified-Since': modified})[0] == 304
+
+
+def test_reload_and_large(cache, tmpdir):
+    etag = cache.get('/app.js').etag
+    path = tmpdir.join('www', 'app.js')
+    path.write('var a = 2;')
+    os.utime(str(path), (1, 1))
+    assert cache.get('/app.js').etag != etag
+
+    code, headers, entry, body = cache.respond('/big.bin', {'Accept-Encoding': 'gzip'})
+    assert code == 200 and body is None
+    assert dict(headers)['Content-Length'] == str(MAX_CACHED_SIZE + 1)
+
+
+def test_outside_root(cache):
+    assert cache.respond('/../secret.txt', {})[0] == 404
+    assert cache.respond('/%2e%2e/secret.txt', {})[0] == 404
+    assert cache.respond('/missing.html', {})[0] == 404
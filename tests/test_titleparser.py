@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.titleparser module"""
+import os
+import time
+from datetime import datetime
+
+from rssdldmng.rssdld.titleparser import parse, normalize_name
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'data', 'titles.txt')
+
+
+def load_corpus():
+    corpus = []
+    with open(CORPUS) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            title, season, episode, last, quality, airdate = [x.strip() for x in line.split('|')]
+            airdate = datetime.strptime(airdate, '%Y-%m-%d').date() if airdate else None
+            corpus.append((title, (int(season), int(episode), int(last), quality, airdate)))
+    return corpus
+
+
+def test_corpus():
+    for title, expected in load_corpus():
+        assert tuple(parse(title)) == expected, title
+
+
+def test_normalize_name():
+    assert normalize_name('Law & Order: SVU') == 'Law & Order SVU'
+    assert normalize_name('Who? <What> "Where"') == 'Who What Where'
+
+
+def test_parse_10k_titles():
+    titles = ['{0} #{1}'.format(t, i) for i in range(300) for t, _ in load_corpus()][:10000]
+    start = time.perf_counter()
+    for t in titles:
+        parse.__wrapped__(t)
+    # generous bound, only meant to catch gross regressions (~100ms here)
+    assert time.perf_counter() - start < 1.0
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.trakt module"""
+import time
+
+from rssdldmng.rssdld.trakt import ShowListCache
+
+
+def test_show_list_cache(tmpdir):
+    path = str(tmpdir.join('trakt_lists.json'))
+    cache = ShowListCache(path, 60)
+    assert cache.get('watchlist') is None
+    assert not cache.is_fresh('watchlist')
+    assert cache.put('watchlist', ['Show One', 'Show Two'])
+    assert not cache.put('watchlist', ['Show One', 'Show Two'])
+    assert cache.is_fresh('watchlist')
+
+    cache = ShowListCache(path, 60)
+    assert cache.get('watchlist') == ['Show One', 'Show Two']
+    cache.lists['watchlist']['fetched'] = time.time() - 120
+    assert not cache.is_fresh('watchlist')
+    assert cache.get('watchlist') == ['Show One', 'Show Two']
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""unit tests for the rssdldmng.rssdld.transmission module"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from rssdldmng.rssdld.transmission import Torrent, TorrentSnapshot, Transmission
+from rssdldmng.transmission import BadRequest, Transmission as TC
+
+
+def torrent(hash, left=0, status=6, id=None):
+    return {'id': id if id is not None else hash, 'name': hash, 'hashString': hash, 'status': status, 'eta': -1,
+            'totalSize': 100, 'leftUntilDone': left, 'rateDownload': 0}
+
+
+class FakeRPC(object):
+    def __init__(self, torrents):
+        self.torrents = torrents
+        self.calls = []
+
+    def __call__(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        return {'torrents': self.torrents}
+
+
+def make_client(torrents, rpc=FakeRPC):
+    tc = Transmission({}, client=rpc(torrents))
+    # drop the connection check
+    tc.tc.calls = []
+    return tc
+
+
+def test_snapshot_single_rpc():
+    tc = make_client([torrent('aaaa'), torrent('bbbb', left=50)])
+    snapshot = tc.snapshot()
+    assert len(tc.tc.calls) == 1
+    assert 'ids' not in tc.tc.calls[0][1]
+    assert len(snapshot) == 2
+    assert snapshot.get('AAAA').progress == 100.0
+    assert snapshot.get('bbbb').progress == 50.0
+    assert 'cccc' not in snapshot
+    assert snapshot.get(None) is None
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    pass
+
+
+class FakeTransmissionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self.server.requests.append(body['method'])
+        if self.server.failures:
+            self.server.failures -= 1
+            return self.reply(503, b'busy')
+        if self.headers.get('X-Transmission-Session-Id') != self.server.session_id:
+            return self.reply(409, b'', {'X-Transmission-Session-Id': self.server.session_id})
+        self.reply(200, json.dumps({'result': 'success', 'tag': body['tag'],
+                                    'arguments': {'torrents': []}}).encode('utf-8'))
+
+    def reply(self, code, body, headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def rpcserver():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTransmissionHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.requests = []
+    server.failures = 0
+    server.session_id = 'session-1'
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_rpc_keep_alive(rpcserver):
+    tc = TC(port=rpcserver.server_address[1], backoff=0.01)
+    for _ in range(10):
+        assert tc('torrent-get', fields=['name']) == {'torrents': []}
+    # one extra request for the session id, all on one connection
+    assert len(rpcserver.requests) == 11
+    assert rpcserver.connections == 1
+
+    # transmission restarted with a new session id
+    rpcserver.session_id = 'session-2'
+    tc('session-stats')
+    assert len(rpcserver.requests) == 13
+    assert tc.stats()['torrent-get']['calls'] == 10
+    tc.close()
+
+
+def test_rpc_retry(rpcserver):
+    tc = TC(port=rpcserver.server_address[1], retries=3, backoff=0.01)
+    rpcserver.failures = 2
+    assert tc('session-stats') == {'torrents': []}
+    assert tc.stats()['session-stats']['retries'] == 2
+
+    rpcserver.failures = 10
+    with pytest.raises(Exception):
+        tc('session-stats')
+    assert rpcserver.failures == 6
+    assert tc.stats()['session-stats']['errors'] == 1
+
+    # a server that never accepts the session id does not loop forever
+    rpcserver.failures = 0
+    rpcserver.session_id = None
+    with pytest.raises(BadRequest):
+        tc('session-stats')
+    tc.close()
+
+
+class FakeMutationRPC(FakeRPC):
+    def __call__(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if method == 'torrent-add':
+            if 'bad' in kwargs['filename']:
+                raise Exception('invalid magnet')
+            return {'torrent-added': {'hashString': kwargs['filename']}}
+        return None
+
+
+def test_command_buffer():
+    tc = make_client([], FakeMutationRPC)
+    snapshot = TorrentSnapshot([Torrent(torrent('run1', status=4)), Torrent(torrent('stop1', status=0)),
+                                Torrent(torrent('run2', status=4)), Torrent(torrent('done1'))])
+    results = {}
+    commands = tc.commands(snapshot)
+    commands.start('RUN1')                      # already running: dropped
+    commands.start('stop1')
+    commands.stop('done1')
+    commands.start('run2')
+    commands.remove('run2')                     # start then remove: one remove
+    commands.start('run2')                      # remove wins
+    commands.remove('gone')                     # not in transmission: dropped
+    commands.add('magnet:a', '/dl', 'AAAA', lambda ok: results.setdefault('a', ok))
+    commands.add('magnet:a', '/dl', 'aaaa')     # duplicate add
+    commands.add('magnet:bad', '/dl', 'BBBB', lambda ok: results.setdefault('b', ok))
+    commands.flush()
+
+    assert [c[0] for c in tc.tc.calls] == ['torrent-add', 'torrent-add', 'torrent-stop', 'torrent-start', 'torrent-remove']
+    assert tc.tc.calls[2][1]['ids'] == ['done1']
+    assert tc.tc.calls[3][1]['ids'] == ['stop1']
+    assert tc.tc.calls[4][1]['ids'] == ['run2']
+    assert results == {'a': True, 'b': False}
+
+    tc.tc.calls = []
+    assert commands.flush() == {}
+    assert tc.tc.calls == []
+
+
+class FakeDeltaRPC(FakeRPC):
+    def __init__(self, torrents):
+        FakeRPC.__init__(self, torrents)
+        self.changed = []
+        self.removed = []
+
+    def __call__(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if kwargs.get('ids') == 'recently-active':
+            return {'torrents': self.changed, 'removed': self.removed}
+        return {'torrents': self.torrents}
+
+
+def test_snapshot_recently_active(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('rssdldmng.rssdld.transmission.time.time', lambda: now[0])
+    tc = make_client([torrent('aaaa', left=50, id=1), torrent('bbbb', id=2), torrent('cccc', id=3)], FakeDeltaRPC)
+    assert len(tc.snapshot()) == 3
+    assert 'ids' not in tc.tc.calls[-1][1]
+
+    now[0] += 50
+    tc.tc.changed = [torrent('aaaa', left=0, id=1), torrent('dddd', left=100, id=4)]
+    tc.tc.removed = [2]
+    snapshot = tc.snapshot()
+    assert tc.tc.calls[-1][1]['ids'] == 'recently-active'
+    assert sorted(snapshot.torrents) == ['aaaa', 'cccc', 'dddd']
+    assert snapshot.get('aaaa').progress == 100.0
+    assert snapshot.changed == {'aaaa', 'bbbb', 'dddd'} and not snapshot.full
+    # read-only view, no rpc
+    calls = len(tc.tc.calls)
+    assert sorted(tc.lastSnapshot().torrents) == ['aaaa', 'cccc', 'dddd']
+    assert len(tc.tc.calls) == calls
+
+    # a poll just after the 60s transmission window is read in full
+    now[0] += 58
+    tc.snapshot()
+    assert 'ids' not in tc.tc.calls[-1][1]
+
+    # polled too late for the recently-active window
+    now[0] += 120
+    tc.snapshot()
+    assert 'ids' not in tc.tc.calls[-1][1]
+    assert len(tc.snapshot()) == 3
+
+    # periodic full resync
+    for _ in range(12):
+        now[0] += 50
+        tc.snapshot()
+    assert [c[1].get('ids') for c in tc.tc.calls[-12:]].count(None) == 1